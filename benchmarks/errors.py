@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# error matching on synthetic OUTCAR and yh.log files, e.g. python benchmarks/errors.py --outcar 50
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from calculation.vasp.workflow.etype import Errors, ErrorCatalogue
+from utils.spath import SPath
+
+OUTCAR_LINES = [
+    " ----------------------------------------- Iteration    {i}(   1)  ---------------------",
+    "   band No.  band energies     occupation",
+    "       {i}     -12.3456      2.00000",
+    "  total charge     0.000  0.000  0.000  0.000",
+    "  free energy    TOTEN  =      -123.45678901 eV",
+    "  POTLOK:  cpu time    0.0123: real time    0.0124",
+]
+YH_LINES = [
+    "DAV:   {i}    -0.123456E+03   -0.12345E-02   -0.12345E-03  1000   0.123E-01",
+    "   {i} F= -.12345678E+03 E0= -.12345678E+03  d E =-.123456E-03  mag=     2.0000",
+    "yhrun: Job step {i} running on cn[{i}-{i}]",
+]
+
+
+def _write(path, templates, megabytes, errors):
+    # errors land at random lines, the rest repeats the templates
+    rng = random.Random(0)
+    size, i = megabytes * 1e6, 0
+    with open(path, "w") as f:
+        while f.tell() < size:
+            i += 1
+            f.write(templates[i % len(templates)].format(i=i) + "\n")
+            if errors and rng.random() < 3e-5:
+                f.write(f"  {rng.choice(errors)}\n")
+
+
+def _keyword_passes(path: SPath):
+    # ErrType matching before the catalogue, one reversed read of the file per keyword
+    hits = set()
+    for e in Errors:
+        for code, keyword in e.value.items():
+            for line in path.readline_text_reversed():
+                if keyword in line:
+                    hits.add(code)
+    return hits
+
+
+def _per_line(path: SPath):
+    # every keyword tested on every line
+    keywords = [(code, keyword) for e in Errors for code, keyword in e.value.items()]
+    hits = set()
+    for line in path.readline_text():
+        for code, keyword in keywords:
+            if keyword in line:
+                hits.add(code)
+    return hits
+
+
+def _catalogue(path: SPath):
+    hits, _ = ErrorCatalogue().scan(path)
+    return {code for _, code, _ in hits}
+
+
+MATCHERS = {"keyword passes": _keyword_passes, "per line": _per_line, "catalogue": _catalogue}
+
+
+@click.command()
+@click.option("--outcar", default=20, type=int, help="OUTCAR size in MB")
+@click.option("--yhlog", default=5, type=int, help="yh.log size in MB")
+@click.option("--skip", multiple=True, type=click.Choice(list(MATCHERS)),
+              help="matchers to leave out, keyword passes takes minutes on large files")
+def main(outcar, yhlog, skip):
+    keywords = [keyword for e in Errors for keyword in e.value.values()]
+    with tempfile.TemporaryDirectory() as tmp:
+        files = {"OUTCAR": (SPath(tmp) / "OUTCAR", OUTCAR_LINES, outcar),
+                 "yh.log": (SPath(tmp) / "yh.log", YH_LINES, yhlog)}
+        print(f"{'file':<8}{'MB':>6}" + "".join(f"{name + ' s':>18}" for name in MATCHERS
+                                             if name not in skip) + "  codes")
+        for name, (path, templates, megabytes) in files.items():
+            _write(path, templates, megabytes, keywords)
+            row, found = [], []
+            for matcher, func in MATCHERS.items():
+                if matcher in skip:
+                    continue
+                start = time.perf_counter()
+                found.append(func(path))
+                row.append(time.perf_counter() - start)
+            same = "" if all(hits == found[0] for hits in found) else " (MISMATCH)"
+            print(f"{name:<8}{os.path.getsize(path) / 1e6:>6.0f}" +
+                  "".join(f"{t:>18.2f}" for t in row) +
+                  f"  {','.join(map(str, sorted(found[0])))}{same}")
+
+
+if __name__ == '__main__':
+    main()
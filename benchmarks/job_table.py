@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# initialization of the job table, e.g. python benchmarks/job_table.py --rows 10000 --rows 100000
+
+import os
+import sys
+import time
+import tempfile
+import warnings
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils import ALL_JOB_LABEL
+from utils.log import LogCsv
+from utils.store import JobStore
+from utils.journal import JournalLog
+from utils.spath import SPath
+from utils.tools import dataframe_from_dict
+
+
+def _rows(n):
+    return (["", "PD", f"/scratch/stru/s{i:07d}", f"s{i:07d}.sh", ""] for i in range(n))
+
+
+def _append_loop(path, n):
+    # LogCsv.touch before the bulk path, one DataFrame.append per row
+    rows = list(_rows(n))
+    tmp = dataframe_from_dict(dict(zip(ALL_JOB_LABEL, rows[0])))
+    for row in rows[1:]:
+        tmp = tmp.append(dataframe_from_dict(dict(zip(ALL_JOB_LABEL, row))), ignore_index=True)
+    LogCsv(path).apply_(tmp)
+
+
+BACKENDS = {
+    "csv": lambda d, n: LogCsv(d / "all_job.csv").touch(ALL_JOB_LABEL, _rows(n)),
+    "sqlite": lambda d, n: JobStore(d / "all_job.db").touch(ALL_JOB_LABEL, _rows(n)),
+    "journal": lambda d, n: JournalLog(d / "all_job.journal").touch(ALL_JOB_LABEL, _rows(n)),
+}
+
+
+def _time(func, n):
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        func(SPath(tmp), n)
+        return time.perf_counter() - start
+
+
+@click.command()
+@click.option("--rows", "sizes", multiple=True, type=int, default=[10000, 100000, 1000000],
+              help="table sizes")
+@click.option("--loop_max", default=10000, type=int,
+              help="largest table for the DataFrame.append loop, it is quadratic")
+def main(sizes, loop_max):
+    # DataFrame.append is deprecated, it warns once per row
+    warnings.simplefilter("ignore", FutureWarning)
+    print(f"{'rows':>9}{'append loop s':>15}" + "".join(f"{name + ' s':>11}" for name in BACKENDS))
+    for n in sizes:
+        loop = f"{_time(lambda d, k: _append_loop(d / 'all_job.csv', k), n):.2f}" \
+            if n <= loop_max else "-"
+        times = [_time(func, n) for func in BACKENDS.values()]
+        print(f"{n:>9}{loop:>15}" + "".join(f"{t:>11.2f}" for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# startup time of every vasp.py subcommand, e.g. python benchmarks/startup.py --repeat 10
+
+import os
+import re
+import sys
+import statistics
+import subprocess
+import time
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ("pandas", "numpy", "scipy", "pymatgen", "spglib", "seekpath", "pexpect", "yaml", "monty")
+
+
+def _time(args, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), min(times)
+
+
+def _heavy(args):
+    # packages the command loaded, read from -X importtime. A lazily imported package only
+    # shows up through its submodules
+    err = subprocess.run([sys.executable, "-X", "importtime"] + args, cwd=ROOT,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    loaded = {name.split(".")[0] for name in re.findall(r"\|\s*([\w.]+)$", err, re.M)}
+    return [name for name in HEAVY if name in loaded]
+
+
+@click.command()
+@click.option("--repeat", default=5, type=int, help="runs per subcommand")
+@click.option("--command", "commands", multiple=True, help="subcommands to time, default all")
+def main(repeat, commands):
+    sys.path.insert(0, ROOT)
+    from vasp import vasp
+
+    commands = commands or sorted(vasp.commands)
+    bare, _ = _time([sys.executable, "-c", "pass"], repeat)
+    print(f"{'command':<12}{'median ms':>10}{'min ms':>10}{'over bare':>11}  heavy imports")
+    print(f"{'(python)':<12}{bare * 1000:>10.1f}")
+    for command in commands:
+        args = ["vasp.py", command, "--help"]
+        median, fastest = _time([sys.executable] + args, repeat)
+        heavy = _heavy(args)
+        print(f"{command:<12}{median * 1000:>10.1f}{fastest * 1000:>10.1f}"
+              f"{(median - bare) * 1000:>11.1f}  {','.join(heavy) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
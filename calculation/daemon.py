@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import signal
+import socket
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.yhurm import TianHeWorker, TianHeJob
+from utils.spath import SPath
+from utils import ALL_JOB_LOG, ALL_JOB_LOCK, TH_LOCAL
+from utils.tools import FileLock
+from calculation.npc import Npc, StepChain, max_resources
+from calculation.vasp.job import RunningRoot
+from utils.lazy import lazy_import
+
+asyncio = lazy_import("asyncio")
+
+TH_DAEMON_SOCK = TH_LOCAL / "daemon.sock"
+
+
+class CampaignJob:
+    def __init__(self, root, name, job_id="", st="PD", result=""):
+        self.root = root
+        self.name = name
+        self.job_id = job_id
+        self.st = st
+        self.result = result
+        self.retries = 0
+        self.due = 0.0
+
+    @property
+    def ids(self):
+        return [i for i in str(self.job_id).split(":") if i and i not in ("?", "nan")]
+
+    @property
+    def values(self):
+        # RESULT is written by the job itself, the daemon only records its final failure
+        values = {"JOBID": self.job_id, "ST": self.st, "NAME": self.name}
+        if self.st == "F":
+            values["RESULT"] = self.result
+        return values
+
+
+class Controller:
+    # ST of a campaign job: PD waiting, SS/R in the queue, RT waiting for a retry, SF yhbatch
+    # failed and waiting for another try, CD successed (and promoted), F failed for good
+    ACTIVE = ("PD", "SS", "R", "RT", "SF")
+
+    def __init__(self, des: SPath = None, interval=60, max_retry=3, backoff=300,
+                 max_backoff=6 * 3600, sock: SPath = TH_DAEMON_SOCK, per_step=False,
+                 bundle_size=1, **kwargs):
+        if bundle_size > 1:
+            raise ValueError("the daemon does not bundle jobs, set [BUNDLE] SIZE = 1")
+        self.worker = TianHeWorker(**kwargs)
+        self.partition = self.worker.partition
+        self.node, self.core = max_resources()
+        self.per_step = per_step
+        self.des = des
+        self.interval = interval
+        self.max_retry = max_retry
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sock = sock
+        self.jobs = {}
+        self.counts = Counter()
+        self.events = deque(maxlen=50)
+        self._changed = {}
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        self._start = time.time()
+        self._last = None
+
+    def load(self):
+        if ALL_JOB_LOG.csv is None:
+            raise FileNotFoundError("No structure files found!")
+        for _, row in ALL_JOB_LOG.csv.iterrows():
+            job_id = "" if str(row["JOBID"]) in ("?", "nan") else str(row["JOBID"])
+            result = "" if str(row["RESULT"]) in ("?", "nan") else str(row["RESULT"])
+            st = "CD" if result == "Successed" else str(row["ST"])
+            self.jobs[str(row["WORKDIR"])] = CampaignJob(str(row["WORKDIR"]), row["NAME"],
+                                                         job_id, st, result)
+        return len(self.jobs)
+
+    def _event(self, job, text):
+        self.events.append(f"{time.strftime('%H:%M:%S')} {SPath(job.root).name}: {text}")
+
+    def _update(self, job, old_root=None):
+        self._changed[old_root or job.root] = job
+
+    def _settle(self, job: CampaignJob, now):
+        try:
+            successed = RunningRoot(SPath(job.root)).successed()
+        except FileNotFoundError:
+            successed = False
+        if successed:
+            self._promote(job)
+            return
+        self._retry(job, now, "RT", "failed")
+
+    def _retry(self, job: CampaignJob, now, st, reason):
+        job.retries += 1
+        if job.retries > self.max_retry:
+            job.st, job.result = "F", "Failed"
+            self.counts["failed"] += 1
+            self._event(job, f"{reason}, no retry left")
+        else:
+            delay = min(self.max_backoff, self.backoff * 2 ** (job.retries - 1))
+            job.st, job.due = st, now + delay
+            self._event(job, f"{reason}, retry {job.retries}/{self.max_retry} in {delay:.0f}s")
+        self._update(job)
+
+    def _promote(self, job: CampaignJob):
+        old_root = job.root
+        job.st, job.result = "CD", "Successed"
+        if self.des is not None:
+            self.des.mkdir(parents=True, exist_ok=True)
+            SPath(job.root).move_to(self.des)
+            job.root = str(self.des / SPath(old_root).name)
+        self.counts["promoted"] += 1
+        self._event(job, "successed")
+        self._update(job, old_root)
+
+    def _prepare(self, job: CampaignJob):
+        # a retry only runs the steps that are not finished yet
+        if job.retries == 0:
+            return True
+        _, name = Npc._cinit(SPath(job.root), per_step=self.per_step)
+        if name is None:
+            self._promote(job)
+            return False
+        job.name = name
+        return True
+
+    def _has_capacity(self):
+        return self.worker.idle_node > 0 and self.worker.used_node < self.worker.alloc
+
+    async def _in_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _submit(self, job: CampaignJob):
+        if not await self._in_thread(self._prepare, job):
+            return
+        if self.per_step:
+            # every step with its own resources, chained by dependencies
+            dft_job = StepChain(job.root, job.name, partition=self.partition)
+        else:
+            dft_job = TianHeJob(job_path=job.root, partition=self.partition, node=self.node,
+                                core=self.core, name=job.name)
+        exit_code, info = await dft_job.ayhbatch()
+        if exit_code != 0:
+            # a bad script or request fails every time, it backs off and gives up like a run
+            self._retry(job, time.time(), "SF", "yhbatch failed")
+            return
+        job.job_id, job.st = info["JOBID"], "SS"
+        self.worker.idle_node -= dft_job.node
+        self.worker.used_node += dft_job.node
+        self.counts["resubmitted" if job.retries else "submitted"] += 1
+        self._event(job, f"submitted as {job.job_id}")
+        self._update(job)
+
+    def _write_log(self):
+        if not self._changed:
+            return
+        changed, self._changed = self._changed, {}
+        # WORKDIR last, the row is matched by its old value
+        with FileLock(ALL_JOB_LOCK):
+            tmp = ALL_JOB_LOG.alter_batch("WORKDIR", [
+                (old_root, {**job.values, "WORKDIR": job.root})
+                for old_root, job in changed.items()
+            ])
+            ALL_JOB_LOG.apply_(tmp)
+
+    async def cycle(self):
+        if await self.worker.asnapshot(self.interval, self._executor) != 0:
+            return
+        now = time.time()
+        queued = self.worker.jobs
+        for job in list(self.jobs.values()):
+            if job.st not in ("SS", "R"):
+                continue
+            ids = [i for i in job.ids if i in queued]
+            if not ids:
+                await self._in_thread(self._settle, job, now)
+            elif job.st == "SS" and any(queued[i].state == "R" for i in ids):
+                job.st = "R"
+                self._update(job)
+        ready = [job for job in self.jobs.values()
+                 if job.st == "PD" or (job.st in ("RT", "SF") and job.due <= now)]
+        for job in ready:
+            if not self._has_capacity():
+                break
+            await self._submit(job)
+        await self._in_thread(self._write_log)
+        self._last = time.time()
+
+    def status(self):
+        return {
+            "pid": os.getpid(),
+            "uptime": round(time.time() - self._start),
+            "last_cycle": round(time.time() - self._last) if self._last else None,
+            "states": dict(Counter(job.st for job in self.jobs.values())),
+            "retrying": [SPath(job.root).name for job in self.jobs.values()
+                         if job.st in ("RT", "SF")],
+            "counts": dict(self.counts),
+            "idle_node": int(self.worker.idle_node or 0),
+            "used_node": int(self.worker.used_node or 0),
+            "events": list(self.events),
+        }
+
+    async def _serve(self, reader, writer):
+        command = (await reader.readline()).decode().strip() or "status"
+        if command == "stop":
+            self._done.set()
+            reply = {"stopping": True}
+        else:
+            reply = self.status()
+        writer.write((json.dumps(reply) + "\n").encode())
+        await writer.drain()
+        writer.close()
+
+    def _finished(self):
+        return not any(job.st in self.ACTIVE for job in self.jobs.values())
+
+    async def _main(self, forever=False):
+        self._done = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._done.set)
+        if self.sock.exists():
+            self.sock.unlink()
+        server = await asyncio.start_unix_server(self._serve, path=str(self.sock))
+        print(f"[...]daemon {os.getpid()} watching {len(self.jobs)} jobs, status on {self.sock}")
+        try:
+            while not self._done.is_set():
+                await self.cycle()
+                if self._finished() and not forever:
+                    print("[...]campaign finished")
+                    break
+                try:
+                    await asyncio.wait_for(self._done.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            server.close()
+            await server.wait_closed()
+            self.sock.unlink()
+            await self._in_thread(self._write_log)
+        print(json.dumps(self.status()["states"]))
+
+    def run(self, forever=False):
+        self.load()
+        asyncio.run(self._main(forever))
+
+
+def query(command="status", sock: SPath = TH_DAEMON_SOCK, timeout=10):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(str(sock))
+        client.sendall(f"{command}\n".encode())
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data)
+
+
+if __name__ == '__main__':
+    pass
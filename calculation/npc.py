@@ -1,60 +1,302 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import heapq
 import threading
+from collections import deque
+from queue import Empty
+from functools import partial
+from itertools import chain
+from statistics import median
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing.pool import Pool
 
-from utils.yhurm import TianHeWorker, TianHeJob
+from utils.yhurm import TianHeWorker, TianHeJob, TianHeTime
+from utils.yhsim import InlineExecutor, run_virtual
 from utils.spath import SPath
-from utils import ALL_JOB_LOG, ALL_JOB_LABEL
+from utils import ALL_JOB_LOG, ALL_JOB_LOCK, ALL_JOB_LABEL, TH_BUNDLE, BUNDLE_PREFIX
+from utils.tools import FileLock
 from calculation.vasp.workflow import WorkflowParser
 from calculation.vasp.job import RunningRoot
+from calculation.vasp.analysis import CostEstimator, WalltimeModel
+from utils.lazy import lazy_import
 from config import WORKFLOW, CONDOR
 
+asyncio = lazy_import("asyncio")
+
+
+def max_resources(workflow=None):
+    if workflow is None:
+        workflow = WORKFLOW
+    max_needed_node, max_needed_core = 0, 0
+    for _, val in workflow.items():
+        if max_needed_node < val["node"]:
+            max_needed_node = val["node"]
+        if max_needed_core < val["core"]:
+            max_needed_core = val["core"]
+    return max_needed_node, max_needed_core
+
+
+POLICIES = ("fifo", "shortest", "longest", "mixed")
+
+
+def _job_steps(root, name, remaining=True):
+    if ":" in name:
+        return [WorkflowParser.step_of(i) for i in name.split(":")]
+    if not remaining:
+        return list(WORKFLOW.keys())
+    return list(RunningRoot(root).get_crun_workflow().keys())
+
+
+# a missing or unreadable structure file or stat.log, a step or a model parameter set that is
+# not there
+ESTIMATE_ERRORS = (FileNotFoundError, StopIteration, ValueError, IndexError, KeyError)
+
+
+def _estimate(item):
+    root, name = item
+    root = SPath(root)
+    try:
+        cost, reason = CostEstimator().cost(root, _job_steps(root, name)), "no structure file"
+    except ESTIMATE_ERRORS as err:
+        cost, reason = None, repr(err)
+    if cost is None:
+        print(f"[...]{root}: no cost estimate, median cost used ({reason})")
+    return cost
+
+
+def _predict(item):
+    model, root, name, remaining = item
+    root = SPath(root)
+    try:
+        times, reason = model.predict_structure(root, _job_steps(root, name, remaining)), \
+            "no structure file"
+    except ESTIMATE_ERRORS as err:
+        times, reason = None, repr(err)
+    if times is None:
+        print(f"[...]{root}: no walltime prediction, submitted without time limit ({reason})")
+    return times
+
+
+def predict_times(jobs, model: WalltimeModel, n=4, remaining=True):
+    pool = Pool(n)
+    times = pool.map(_predict, [(model, job["WORKDIR"], job["NAME"], remaining) for job in jobs])
+    pool.close()
+    pool.join()
+    print(f"walltime predicted: {len([t for t in times if t])}/{len(jobs)} jobs")
+    return times
+
+
+def job_limits(jobs, model: WalltimeModel, n=4):
+    jobs = [job for job in jobs if str(job["JOBID"]) not in ("", "?", "nan")]
+    limits = {}
+    for job, times in zip(jobs, predict_times(jobs, model, n, remaining=False)):
+        if not times:
+            continue
+        job_ids = str(job["JOBID"]).split(":")
+        if len(job_ids) > 1:
+            for job_id, step in zip(job_ids, times):
+                limits[job_id] = times[step]
+        else:
+            limits[job_ids[0]] = max(limits.get(job_ids[0], 0), sum(times.values()))
+    return limits
+
+
+def _slurm_time(seconds):
+    if seconds is None:
+        return None
+    return TianHeTime(secs=seconds).to_slurm()
+
+
+def order_jobs(jobs, policy="fifo", n=4):
+    if policy == "fifo":
+        return jobs
+    if policy not in POLICIES:
+        raise ValueError(f"unknown policy: {policy}")
+    pool = Pool(n)
+    costs = pool.map(_estimate, [(job["WORKDIR"], job["NAME"]) for job in jobs])
+    pool.close()
+    pool.join()
+    known = [c for c in costs if c is not None]
+    default = median(known) if known else 0
+    costs = [default if c is None else c for c in costs]
+    print(f"cost estimated: {len(known)}/{len(jobs)} jobs")
+    return order_by_cost(jobs, costs, policy)
+
+
+def order_by_cost(jobs, costs, policy="fifo"):
+    if policy == "fifo":
+        return jobs
+    if policy == "mixed":
+        # alternate both ends so long jobs start early and short ones fill the gaps
+        ranked = deque(sorted(range(len(jobs)), key=lambda i: costs[i]))
+        ordered = []
+        while ranked:
+            ordered.append(jobs[ranked.pop()])
+            if ranked:
+                ordered.append(jobs[ranked.popleft()])
+        return ordered
+
+    sign = 1 if policy == "shortest" else -1
+    heap = [(sign * cost, idx) for idx, cost in enumerate(costs)]
+    heapq.heapify(heap)
+    return [jobs[heapq.heappop(heap)[1]] for _ in range(len(heap))]
+
+
+class StepChain:
+    def __init__(self, job_path, names, partition="work", times=None):
+        self.path = job_path
+        self.name = names
+        self.jobs = []
+        for name in names.split(":"):
+            step = WorkflowParser.step_of(name)
+            node, core = WorkflowParser.resources(WORKFLOW[step])
+            time = _slurm_time(times.get(step)) if times else None
+            self.jobs.append(
+                (step, TianHeJob(job_path=job_path, partition=partition,
+                                 node=node, core=core, name=name, time=time))
+            )
+        self.node = sum(job.node for _, job in self.jobs)
+        self.members = None
+
+    def _prepare(self, step, job, submitted):
+        job.dependency = submitted.get(WORKFLOW[step].get("parent"))
+
+    def _rollback(self, submitted):
+        TianHeWorker.yhcancel(list(submitted.values()))
+
+    def _info(self, submitted):
+        return 0, {"JOBID": ":".join(submitted.values()),
+                   "WORKDIR": self.path, "NAME": self.name}
+
+    def yhbatch(self):
+        submitted = {}
+        for step, job in self.jobs:
+            self._prepare(step, job, submitted)
+            ok, info = job.yhbatch()
+            if ok != 0:
+                self._rollback(submitted)
+                return ok, None
+            submitted[step] = info["JOBID"]
+        return self._info(submitted)
+
+    async def ayhbatch(self):
+        submitted = {}
+        for step, job in self.jobs:
+            self._prepare(step, job, submitted)
+            ok, info = await job.ayhbatch()
+            if ok != 0:
+                self._rollback(submitted)
+                return ok, None
+            submitted[step] = info["JOBID"]
+        return self._info(submitted)
+
 
 class Producer(threading.Thread):
     Finished = True
 
-    def __init__(self, queue):
+    def __init__(self, queue, per_step=False, bundle_size=1, policy="fifo", process=4,
+                 predict_time=False):
         super(Producer, self).__init__()
+        if per_step and bundle_size > 1:
+            raise ValueError("per step submission can not be bundled!")
+        if policy not in POLICIES:
+            raise ValueError(f"unknown policy: {policy}")
         self.queue = queue
+        self.per_step = per_step
+        self.bundle_size = bundle_size
+        self.policy = policy
+        self.process = process
+        self.model = None
+        if predict_time:
+            self.model = WalltimeModel.load()
+            if self.model is None:
+                print("[...]walltime model not found, submit without time limit")
+        self._nbundle = 0
+
+    def _bundle(self, jobs):
+        TH_BUNDLE.mkdir(exist_ok=True)
+        self._nbundle += 1
+        filename = f"{BUNDLE_PREFIX}{self._nbundle:06d}.sh"
+        members = [(job.path, job.name) for job in jobs]
+        WorkflowParser(work_root=TH_BUNDLE).write_bundle_sh(members, filename)
+        times = [job.time for job in jobs]
+        time = None
+        if all(times):
+            time = max(times, key=lambda t: TianHeTime.from_string(t).seconds)
+        return TianHeJob(job_path=TH_BUNDLE, partition=jobs[0].partition,
+                         node=sum(job.node for job in jobs), core=sum(job.core for job in jobs),
+                         name=filename, members=[job.path for job in jobs], time=time)
 
     def run(self):
         if not ALL_JOB_LOG.path.exists():
             raise Exception("available job not found!")
 
-        max_needed_node, max_needed_core = 0, 0
-        for _, val in WORKFLOW.items():
-            if max_needed_node < val["node"]:
-                max_needed_node = val["node"]
-            if max_needed_core < val["core"]:
-                max_needed_core = val["core"]
+        max_needed_node, max_needed_core = max_resources()
         if ALL_JOB_LOG.csv is None:
             raise FileNotFoundError("No structure files found!")
              
-        for index, job in ALL_JOB_LOG.csv.iterrows():
+        partition = CONDOR.get("ALLOW", "PARTITION")
+        bundle = []
+        jobs = order_jobs([job for _, job in ALL_JOB_LOG.csv.iterrows()], self.policy, self.process)
+        times = [None] * len(jobs)
+        if self.model is not None:
+            times = predict_times(jobs, self.model, self.process)
+        for job, time in zip(jobs, times):
+            if self.per_step:
+                self.queue.put(StepChain(job["WORKDIR"], job["NAME"], partition=partition,
+                                         times=time))
+                continue
             dft_job = TianHeJob(job_stat=job["RESULT"], job_path=job["WORKDIR"],
                                 partition=CONDOR.get("ALLOW", "PARTITION"),
-                                node=max_needed_node, core=max_needed_core, name=job["NAME"])
-            self.queue.put(dft_job)
+                                node=max_needed_node, core=max_needed_core, name=job["NAME"],
+                                time=_slurm_time(sum(time.values())) if time else None)
+            if self.bundle_size <= 1:
+                self.queue.put(dft_job)
+                continue
+            bundle.append(dft_job)
+            if len(bundle) == self.bundle_size:
+                self.queue.put(self._bundle(bundle))
+                bundle = []
+        if bundle:
+            self.queue.put(self._bundle(bundle))
         self.queue.put(self.Finished)
 
 
+def _log_items(job, info):
+    if job.members is None:
+        return [(job.path, info)]
+    values = {"ST": info["ST"]}
+    if info.get("JOBID") is not None:
+        values["JOBID"] = info["JOBID"]
+    return [(path, values) for path in job.members]
+
+
+def _write_items(items):
+    # job scripts write their RESULT meanwhile, the whole table is rewritten under the lock
+    with FileLock(ALL_JOB_LOCK):
+        tmp = ALL_JOB_LOG.alter_batch("WORKDIR", items)
+        ALL_JOB_LOG.apply_(tmp)
+
+
 class Submitter(threading.Thread):
     Finished = True
 
-    def __init__(self, queue, stime=0.5, flush_time=60, **kwargs):
+    def __init__(self, queue, stime=0.5, flush_time=60, clock=None, **kwargs):
         super(Submitter, self).__init__()
         self.queue = queue
         self.worker = TianHeWorker(**kwargs)
         self.stime = stime
         self.ftime = flush_time
-        self.worker.flush()
+        self.sleep = clock.sleep if clock is not None else sleep
+        self.ttl = min(self.worker.ttl, flush_time)
 
     def run(self):
-        allow_node = CONDOR.getint("ALLOW", "TOTAL_NODE")
+        allow_node = self.worker.alloc
         print("Start job submission...")
         print(f"User node limit: {allow_node}")
+        while self.worker.snapshot(self.ttl) != 0:
+            self.sleep(self.ftime)
         while True:
             print(f"User total used node: {self.worker.used_node}")
             print(f"System total idle node: {self.worker.idle_node}")
@@ -63,77 +305,249 @@ class Submitter(threading.Thread):
                 break
             while self.worker.idle_node <= 0 or self.worker.used_node >= allow_node:
                 print(f"waiting for idle resource...")
-                sleep(self.ftime)
-                self.worker.flush()
+                self.sleep(self.ftime)
+                self.worker.snapshot(self.ttl)
             exit_code, info = job.yhbatch()
             if exit_code == 0:
                 info.update({"ST": "SS"})
                 self.worker.idle_node -= job.node
                 self.worker.used_node += job.node
             else:
-                info.update({"ST": "SF"})
-            tmp = ALL_JOB_LOG.alter_many("WORKDIR", job.path, info)
-            ALL_JOB_LOG.apply_(tmp)
-            sleep(self.stime)
+                info = {"ST": "SF"}
+            if self.worker.record:
+                _write_items(_log_items(job, info))
+            self.sleep(self.stime)
+
+
+class AsyncSubmitter(threading.Thread):
+    Finished = True
+
+    def __init__(self, queue, flush_time=60, max_inflight=16, clock=None, **kwargs):
+        super(AsyncSubmitter, self).__init__()
+        self.queue = queue
+        self.clock = clock
+        self.worker = TianHeWorker(**kwargs)
+        self.ftime = flush_time
+        self.ttl = min(self.worker.ttl, flush_time)
+        self.max_inflight = max_inflight
+        self.allow_node = self.worker.alloc
+        self.submitted = 0
+        self.idle_node_seconds = 0.0
+        self._updates = []
+        self._waiting = False
+        self._finished = False
+        self._executor = ThreadPoolExecutor(max_workers=2) if clock is None else InlineExecutor()
+
+    def run(self):
+        try:
+            if self.clock is None:
+                asyncio.run(self._main())
+            else:
+                run_virtual(self._main(), self.clock)
+        except BaseException:
+            # the producer blocks on a full queue, take what is left so it can finish
+            while not self._finished:
+                try:
+                    self._get(timeout=1)
+                except Empty:
+                    pass
+            raise
+
+    def _get(self, timeout=None):
+        job = self.queue.get(timeout=timeout)
+        if job is self.Finished:
+            self._finished = True
+        return job
+
+    async def _in_thread(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    @property
+    def spare_node(self):
+        return max(0, min(self.worker.idle_node, self.allow_node - self.worker.used_node))
+
+    def _has_capacity(self):
+        return self.worker.idle_node > 0 and self.worker.used_node < self.allow_node
+
+    def report(self):
+        loop = asyncio.get_running_loop()
+        elapsed = max(loop.time() - self._start, 1e-6)
+        print(f"User total used node: {self.worker.used_node}")
+        print(f"System total idle node: {self.worker.idle_node}")
+        print(f"submitted: {self.submitted}, "
+              f"rate: {self.submitted * 60 / elapsed:.2f} jobs/min, "
+              f"idle node seconds: {self.idle_node_seconds:.0f}")
+
+    async def _flusher(self):
+        loop = asyncio.get_running_loop()
+        last = loop.time()
+        while not self._done.is_set():
+            try:
+                await asyncio.wait_for(self._done.wait(), timeout=self.ftime)
+            except asyncio.TimeoutError:
+                pass
+            waiting = self._waiting
+            try:
+                if await self.worker.asnapshot(self.ttl, self._executor) != 0:
+                    continue
+                now = loop.time()
+                # capacity freed at some unknown point of the last cycle, count half of it
+                if waiting:
+                    self.idle_node_seconds += self.spare_node * (now - last) / 2
+                last = now
+                await self._write_log()
+                self.report()
+            except Exception as err:
+                # one bad cycle must not stop the flusher, the submissions wait on it
+                print(f"[...]flush failed: {err!r}")
+            async with self._capacity:
+                self._capacity.notify_all()
+
+    async def _write_log(self):
+        if not self._updates:
+            return
+        updates, self._updates = self._updates, []
+        try:
+            await self._in_thread(self._apply_updates, updates)
+        except Exception:
+            # keep the rows for the next cycle
+            self._updates[:0] = updates
+            raise
+
+    def _apply_updates(self, updates):
+        if self.worker.record:
+            _write_items(updates)
+
+    async def _acquire(self, job):
+        async with self._capacity:
+            if not self._has_capacity():
+                print(f"waiting for idle resource...")
+                self._waiting = True
+                await self._capacity.wait_for(self._has_capacity)
+                self._waiting = False
+            self.worker.idle_node -= job.node
+            self.worker.used_node += job.node
+
+    @staticmethod
+    async def _wait_for(coro, flusher):
+        # only the flusher frees capacity, do not wait for it once it has stopped
+        task = asyncio.ensure_future(coro)
+        await asyncio.wait({task, flusher}, return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            return task.result()
+        task.cancel()
+        if flusher.exception() is not None:
+            raise flusher.exception()
+        raise RuntimeError("flusher stopped before the submission finished")
+
+    async def _submit(self, job):
+        async with self._inflight:
+            exit_code, info = await job.ayhbatch()
+        if exit_code == 0:
+            info.update({"ST": "SS"})
+            self.submitted += 1
+        else:
+            info = {"ST": "SF"}
+            async with self._capacity:
+                self.worker.idle_node += job.node
+                self.worker.used_node -= job.node
+                self._capacity.notify_all()
+        self._updates.extend(_log_items(job, info))
+
+    async def _main(self):
+        loop = asyncio.get_running_loop()
+        self._start = loop.time()
+        self._done = asyncio.Event()
+        self._capacity = asyncio.Condition()
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        print("Start job submission...")
+        print(f"User node limit: {self.allow_node}")
+        while await self.worker.asnapshot(self.ttl, self._executor) != 0:
+            await asyncio.sleep(self.ftime)
+        flusher = asyncio.create_task(self._flusher())
+        submissions = set()
+        while True:
+            job = await self._in_thread(self._get)
+            if job is self.Finished:
+                break
+            await self._wait_for(self._acquire(job), flusher)
+            task = asyncio.create_task(self._submit(job))
+            submissions.add(task)
+            task.add_done_callback(submissions.discard)
+        if submissions:
+            await asyncio.gather(*submissions)
+        self._done.set()
+        await flusher
+        await self._write_log()
+        self.report()
 
 
 class Npc:
-    def __init__(self, structures_path: SPath, interval_time=0.5):
+    def __init__(self, structures_path: SPath, interval_time=0.5, per_step=False, exclusive=False):
         self.structures_path = structures_path
         self.interval_time = interval_time
+        self.per_step = per_step
+        self.exclusive = exclusive
 
     @staticmethod
-    def _init(name: SPath, *args, **kwargs):
+    def _write(parser: WorkflowParser, per_step=False):
+        if per_step:
+            return parser.write_step_sh()
+        return parser.write_sh()
+
+    @staticmethod
+    def _init(name: SPath, per_step=False, *args, **kwargs):
         filename_dir = name.mkdir_filename()
         name.copy_to(filename_dir, mv_org=True)
-        return WorkflowParser(work_root=filename_dir, *args, **kwargs).write_sh()
+        return Npc._write(WorkflowParser(work_root=filename_dir, *args, **kwargs), per_step)
 
     @staticmethod
-    def _cinit(cpath: SPath, *args, **kwargs):
+    def _cinit(cpath: SPath, per_step=False, *args, **kwargs):
         cworkflow = RunningRoot(cpath).get_crun_workflow()
         if not cworkflow:
             return cpath, None
-        return WorkflowParser(work_root=cpath, workflow=cworkflow,
-                              *args, **kwargs).write_sh()
+        return Npc._write(WorkflowParser(work_root=cpath, workflow=cworkflow,
+                                         *args, **kwargs), per_step)
+
+    @property
+    def _parser_kwargs(self):
+        return {"exclusive": self.exclusive}
 
     @staticmethod
-    def _make_log(job_dirs):
-        jobs = []
-        for job in job_dirs:
-            root, bash_name = job.get()
-            if bash_name is not None:
-                jobs.append(["", "PD", root, bash_name, ""])
-        try:
-            ALL_JOB_LOG.touch(ALL_JOB_LABEL, jobs)
-        except (AttributeError, IndexError):
+    def _make_log(results, every=10000):
+        # rows go from the pool to the log as they come, nothing holds all of them
+        total = 0
+
+        def rows():
+            nonlocal total
+            for root, bash_name in results:
+                if bash_name is None:
+                    continue
+                total += 1
+                if total % every == 0:
+                    print(f"[...]{total} jobs initialized")
+                yield ["", "PD", root, bash_name, ""]
+
+        jobs = rows()
+        first = next(jobs, None)
+        if first is None:
             raise Exception("Job initialization failed !, check structure files or match pattern!")
-        else:
-            print(f"total: {len(jobs)} jobs initialized!")
+        ALL_JOB_LOG.touch(ALL_JOB_LABEL, chain([first], jobs))
+        print(f"total: {total} jobs initialized!")
 
         return True
 
     def init_jobs(self, pat, n=4):
-        job_pool = Pool(n)
-        job_dirs = []
-        for structure in self.structures_path.walk(pattern=pat, is_file=True):
-            job = job_pool.apply_async(self._init, args=(structure,))
-            job_dirs.append(job)
-
-        job_pool.close()
-        job_pool.join()
-
-        return self._make_log(job_dirs)
+        init = partial(self._init, per_step=self.per_step, **self._parser_kwargs)
+        with Pool(n) as job_pool:
+            return self._make_log(job_pool.imap(
+                init, self.structures_path.walk(pattern=pat, is_file=True), chunksize=64))
 
     def cinit_jobs(self, n=4):
-        job_pool = Pool(n)
-        job_dirs = []
-        for structure in self.structures_path.walk(pattern="*", is_file=False):
-            job = job_pool.apply_async(self._cinit, args=(structure,))
-            job_dirs.append(job)
-        job_pool.close()
-        job_pool.join()
-
-        return self._make_log(job_dirs)
+        cinit = partial(self._cinit, per_step=self.per_step, **self._parser_kwargs)
+        with Pool(n) as job_pool:
+            return self._make_log(job_pool.imap(
+                cinit, self.structures_path.walk(pattern="*", is_file=False), chunksize=64))
 
     def post_process(self):
         pass
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import time
+import subprocess
+
+from utils.yhurm import TianHeJob, TianHeTime
+from utils.spath import SPath
+from utils.wqueue import WorkQueue
+from utils.tools import FileLock
+from utils import ALL_JOB_LOG, ALL_JOB_LOCK, TH_LOCAL, PILOT_SCRIPT
+from calculation.vasp.workflow import WorkflowParser
+from calculation.npc import order_jobs
+from config import CONDOR
+
+TH_PILOT = TH_LOCAL / "pilot"
+
+
+class Pilot:
+    def __init__(self, nodes=4, slice_node=1, slice_core=24, walltime="1-00:00:00",
+                 reserve=600, root: SPath = TH_PILOT):
+        self.root = root
+        self.queue = WorkQueue(root / "queue")
+        self.nodes = nodes
+        self.slice_node = slice_node
+        self.slice_core = slice_core
+        self.walltime = TianHeTime.from_string(walltime)
+        self.reserve = reserve
+
+    @property
+    def slices(self):
+        return max(1, self.nodes // self.slice_node)
+
+    def build_queue(self, policy="fifo", process=4):
+        if not ALL_JOB_LOG.path.exists() or ALL_JOB_LOG.csv is None:
+            raise FileNotFoundError("No structure files found!")
+        jobs = [job for _, job in ALL_JOB_LOG.csv.iterrows()]
+        items = [(job["WORKDIR"], job["NAME"]) for job in order_jobs(jobs, policy, process)]
+        return self.queue.build(items)
+
+    def _get(self):
+        parser = WorkflowParser(work_root=self.root)
+        py = parser._py
+        b = parser._head()
+        b += f"echo \'[...]PILOT START!\'\n"
+        b += f"deadline=$(( $(date +%s) + {int(self.walltime.seconds)} - {self.reserve} ))\n"
+        b += f"for ((slice=0;slice<{self.slices};slice++))\n"
+        b += "  do\n"
+        b += f"  python {py} pull --queue {self.queue.root} --deadline $deadline --slice $slice &\n"
+        b += "done\n"
+        b += "wait\n"
+        b += f"echo \'[...]PILOT DONE!\'"
+        return b
+
+    def write_sh(self):
+        filename = PILOT_SCRIPT
+        self.root.mkdir(parents=True, exist_ok=True)
+        (self.root / filename).write_text(self._get())
+        return self.root, filename
+
+    def submit(self, pilots=1):
+        _, filename = self.write_sh()
+        job = TianHeJob(job_path=self.root, partition=CONDOR.get("ALLOW", "PARTITION"),
+                        node=self.slices * self.slice_node, core=self.slices * self.slice_core,
+                        name=filename, time=self.walltime.to_slurm())
+        job_ids = []
+        for _ in range(pilots):
+            exit_code, info = job.yhbatch()
+            if exit_code == 0:
+                job_ids.append(info["JOBID"])
+        return job_ids
+
+
+class PilotWorker:
+    def __init__(self, queue: WorkQueue, deadline, slice_id=0):
+        self.queue = queue
+        self.deadline = deadline
+        self.job_id = os.environ.get("SLURM_JOB_ID", "")
+        self.owner = f"{self.job_id}.{slice_id}"
+        self.durations = []
+
+    @property
+    def expected(self):
+        if not self.durations:
+            return 0
+        return sum(self.durations) / len(self.durations)
+
+    def _has_time(self):
+        return time.time() + self.expected < self.deadline
+
+    @staticmethod
+    def _record(root, values):
+        # the TSV log is rewritten whole, without the lock a pilot drops what another wrote
+        with FileLock(ALL_JOB_LOCK):
+            tmp = ALL_JOB_LOG.alter_many("WORKDIR", root, values)
+            ALL_JOB_LOG.apply_(tmp)
+
+    def run_one(self, root, name):
+        root = SPath(root)
+        self._record(str(root), {"JOBID": self.job_id, "ST": "R"})
+        start = time.time()
+        with (root / f"slurm-{self.job_id}.out").open("a") as out:
+            exit_code = subprocess.call(["bash", name], cwd=str(root),
+                                        stdout=out, stderr=subprocess.STDOUT)
+        self.durations.append(time.time() - start)
+        return exit_code
+
+    def run(self):
+        while self._has_time():
+            task = self.queue.pull(self.owner)
+            if task is None:
+                print(f"[...]{self.owner}: queue is empty")
+                break
+            idx, (root, name) = task
+            print(f"[...]{self.owner}: start {root}")
+            exit_code = self.run_one(root, name)
+            self.queue.done(idx, exit_code)
+        else:
+            print(f"[...]{self.owner}: walltime nearly used up, stop pulling")
+        return len(self.durations)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import math
+import random
+import threading
+from queue import Queue
+from contextlib import redirect_stdout
+
+from utils.yhurm import TianHeJob, TianHeTime, use_scheduler
+from utils.yhsim import YhSim, VirtualClock
+from calculation.npc import Submitter, AsyncSubmitter, order_by_cost
+
+ENGINES = ("async", "thread")
+
+
+class SubmitSimulation:
+    def __init__(self, jobs=1000, nodes=64, limit=None, job_node=1, job_core=24,
+                 runtime="lognormal:3600,0.5", noise=0.3, latency=0.1, seed=0,
+                 partition="work"):
+        if job_node > nodes:
+            raise ValueError(f"job needs {job_node} nodes, partition has {nodes}")
+        self.jobs = jobs
+        self.nodes = nodes
+        self.limit = nodes if limit is None else limit
+        self.job_node = job_node
+        self.job_core = job_core
+        self.runtime = runtime
+        self.noise = noise
+        self.latency = latency
+        self.seed = seed
+        self.partition = partition
+
+    def _campaign(self, sim: YhSim):
+        rng = random.Random(self.seed + 1)
+        names = [f"sim_{i:06d}.sh" for i in range(self.jobs)]
+        costs = []
+        for name in names:
+            sim.runtimes[name] = sim.sample()
+            # what a cost estimate sees, the real runtime blurred by a log-normal error
+            costs.append(sim.runtimes[name] * math.exp(rng.gauss(0, self.noise)))
+        return names, costs
+
+    @staticmethod
+    def _feed(queue, jobs):
+        # the producer of a real run, a bounded queue hands the jobs over as the submitter takes
+        # them
+        for job in jobs:
+            queue.put(job)
+        queue.put(Submitter.Finished)
+
+    def _submitter(self, queue, clock, engine, stime, ftime, inflight):
+        control_paras = {"partition": self.partition, "total_allowed_node": self.limit,
+                         "ttl": 0, "record": False}
+        if engine == "thread":
+            return Submitter(queue, stime, ftime, clock=clock, **control_paras)
+        return AsyncSubmitter(queue, ftime, inflight, clock=clock, **control_paras)
+
+    def run(self, stime=0.5, ftime=60, policy="fifo", verbose=False, engine="async", qsize=0,
+            inflight=16):
+        if engine not in ENGINES:
+            raise ValueError(f"unknown engine: {engine}")
+        clock = VirtualClock()
+        sim = YhSim(nodes=self.nodes, partition=self.partition, runtime=self.runtime,
+                    seed=self.seed, clock=clock, latency=self.latency)
+        names, costs = self._campaign(sim)
+        queue = Queue(maxsize=qsize)
+        feeder = threading.Thread(target=self._feed, args=(queue, [
+            TianHeJob(job_path=os.getcwd(), partition=self.partition, node=self.job_node,
+                      core=self.job_core, name=name)
+            for name in order_by_cost(names, costs, policy)
+        ]), daemon=True)
+
+        use_scheduler(sim)
+        try:
+            with open(os.devnull, "w") as devnull, \
+                    redirect_stdout(sys.stdout if verbose else devnull):
+                submitter = self._submitter(queue, clock, engine, stime, ftime, inflight)
+                feeder.start()
+                submitter.run()
+        finally:
+            use_scheduler(None)
+        feeder.join()
+        stats = sim.drain()
+        stats["limit_utilization"] = stats["busy_node_seconds"] / (self.limit * stats["makespan"]) \
+            if stats["makespan"] else 0
+        return stats
+
+    @staticmethod
+    def report(stats):
+        print(f"jobs: {stats['jobs']}, states: {stats['states']}")
+        print(f"makespan: {TianHeTime(secs=stats['makespan']).to_slurm()}")
+        print(f"node utilization: {stats['limit_utilization'] * 100:.1f}% of user limit, "
+              f"{stats['utilization'] * 100:.1f}% of partition")
+        print(f"queue wait: mean {stats['wait_mean']:.0f}s, p95 {stats['wait_p95']:.0f}s")
+        print(f"scheduler calls: {', '.join(f'{k} {v}' for k, v in stats['calls'].items())}")
+
+
+if __name__ == '__main__':
+    pass
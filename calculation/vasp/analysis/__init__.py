@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-
+from .cost import CostEstimator
+from .walltime import WalltimeModel, StepRecord, collect_records, WALLTIME_MODEL
+from .progress import StepProgress, running_jobs, running_progress
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from calculation.vasp.inputs import POSCAR, KPOINTS, KPOINTSModes
+from config import WORKFLOW, INCAR_TEMPLATE
+from utils.spath import SPath
+from utils.lazy import lazy_import
+
+np = lazy_import("numpy")
+spg = lazy_import("spglib")
+
+
+class CostEstimator:
+    def __init__(self, workflow=None, templates=None):
+        if workflow is None:
+            workflow = WORKFLOW
+        if templates is None:
+            templates = INCAR_TEMPLATE
+        self.workflow = workflow
+        self.templates = templates
+
+    @staticmethod
+    def find_structure(root: SPath):
+        poscar = root / "POSCAR"
+        if poscar.exists():
+            return poscar
+        if not root.is_dir():
+            return None
+        for tmp in root.walk(pattern="*.*"):
+            if root.name in tmp.name and tmp.suffix not in (".sh", ".log", ".out"):
+                return tmp
+        return None
+
+    @staticmethod
+    def irreducible_kpoints(stru: POSCAR, kmesh):
+        mapping, _ = spg.get_ir_reciprocal_mesh(kmesh, stru.structure, is_shift=[0, 0, 0])
+        return len(np.unique(mapping))
+
+    def nkpoints(self, stru: POSCAR, step):
+        paras = self.workflow[step]
+        ktype = KPOINTSModes.from_string(paras.get("ktype", "G"))
+        kval = paras.get("kval", [0.04])[0]
+        if ktype == KPOINTSModes.LineMode:
+            kpoints = KPOINTS(interval_of_kpoints=kval, style=ktype)
+            kpoints.get_hk_path(stru)
+            return kval * max(1, len(kpoints.kpath) // 2)
+        kpoints = KPOINTS(style=ktype)
+        kpoints.get_kmesh(stru, kval)
+        return self.irreducible_kpoints(stru, kpoints.kmesh)
+
+    def features(self, stru: POSCAR, step):
+        incar = self.templates.get(step) or {}
+        return {
+            "natoms": int(np.sum(stru.symbol_num)),
+            "nspecies": len(stru.symbol),
+            "nkpt": self.nkpoints(stru, step),
+            "encut": float(incar.get("ENCUT", 520)),
+            "ispin": int(incar.get("ISPIN", 1)),
+        }
+
+    @staticmethod
+    def step_cost(features):
+        # bands and plane waves both grow with the cell, the basis with ENCUT^1.5
+        return features["nkpt"] * features["natoms"] ** 2 \
+               * (features["encut"] / 400) ** 1.5 * features["ispin"]
+
+    def cost(self, root: SPath, steps=None):
+        if steps is None:
+            steps = list(self.workflow.keys())
+        structure = self.find_structure(root)
+        if structure is None:
+            return None
+        stru = POSCAR.from_file(structure)
+        return sum(self.step_cost(self.features(stru, step)) for step in steps)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from calculation.vasp.inputs import INCAR
+from calculation.vasp.outputs import OSZICAR
+from calculation.vasp.job import RunningRoot
+from calculation.vasp.workflow import WorkflowParser
+from config import WORKFLOW
+from utils import ALL_JOB_LOG, RUNNING_JOB_LOG
+from utils.spath import SPath
+from utils.journal import normalize_key
+
+
+class StepProgress:
+    # state of a running step from the tails of OSZICAR and OUTCAR, a few hundred kB per step
+    OSZICAR_TAIL = 1 << 16
+    OUTCAR_TAIL = 1 << 19
+    TREND = 3
+    _loop = re.compile(r"LOOP(\+?):\s+cpu time\s+\S+:\s+real time\s+(\S+)")
+    _forces = re.compile(r"FORCES: max atom, RMS\s+(\S+)")
+
+    def __init__(self, step_dir: SPath):
+        self.step_dir = step_dir
+        self.step = step_dir.name
+
+    @staticmethod
+    def _tail(path: SPath, size):
+        # text of the last size bytes from the first whole line on
+        try:
+            with open(path, "rb") as f:
+                end = f.seek(0, 2)
+                f.seek(max(0, end - size))
+                data = f.read()
+        except FileNotFoundError:
+            return ""
+        if end > size:
+            data = data[data.find(b"\n") + 1:]
+        return data.decode(errors="ignore")
+
+    def _oszicar(self):
+        # ionic steps, electronic steps of the ionic steps in the tail and of the current one
+        ionic, d_e, scf, current, scf_d_e = 0, None, [], 0, []
+        for line in self._tail(self.step_dir / "OSZICAR", self.OSZICAR_TAIL).splitlines():
+            step = OSZICAR.parse_line(line)
+            if step is not None:
+                (ionic, fields), = step.items()
+                d_e = fields.get("dE")
+                scf.append(current)
+                current, scf_d_e = 0, []
+            elif OSZICAR.is_electronic_line(line):
+                current += 1
+                try:
+                    scf_d_e.append(float(line.split()[3]))
+                except (IndexError, ValueError):
+                    pass
+        # the first ionic step of the tail may be cut
+        return ionic, d_e, scf[1:] if len(scf) > 1 else scf, current, scf_d_e
+
+    def _outcar(self):
+        # one regex pass over the tail, a Python loop over its lines costs ten times more
+        text = self._tail(self.step_dir / "OUTCAR", self.OUTCAR_TAIL)
+        loop, loop_ = [], []
+        for match in self._loop.finditer(text):
+            (loop_ if match.group(1) else loop).append(float(match.group(2)))
+        forces = [float(match.group(1)) for match in self._forces.finditer(text)]
+        return forces, loop, loop_
+
+    def _incar(self):
+        try:
+            incar = INCAR.from_file(self.step_dir / "INCAR")
+        except (FileNotFoundError, IndexError, ValueError):
+            return 0, -1, 1E-4, None
+        nsw = int(incar.get("NSW") or 0)
+        ibrion = incar.get("IBRION")
+        if ibrion is None:
+            ibrion = -1 if nsw <= 1 else 0
+        ediff = float(incar.get("EDIFF") or 1E-4)
+        ediffg = incar.get("EDIFFG")
+        return nsw, int(ibrion), ediff, float(ediffg) if ediffg is not None else ediff * 10
+
+    @staticmethod
+    def _steps_to(values, target):
+        # steps until |value| reaches target, extrapolated from the geometric decay of values
+        values = [abs(v) for v in values if v]
+        if not values:
+            return None
+        if values[-1] <= target:
+            return 0
+        if len(values) < 2 or values[-1] >= values[0]:
+            return None
+        rate = (values[-1] / values[0]) ** (1 / (len(values) - 1))
+        return math.ceil(math.log(target / values[-1]) / math.log(rate))
+
+    @staticmethod
+    def _mean(values, last=5):
+        values = values[-last:]
+        return sum(values) / len(values) if values else None
+
+    def read(self):
+        ionic, d_e, scf, current, scf_d_e = self._oszicar()
+        forces, loop, loop_ = self._outcar()
+        nsw, ibrion, ediff, ediffg = self._incar()
+        static = nsw <= 1 or ibrion == -1
+
+        # electronic steps left in the current ionic step: like the previous ones, or until dE
+        # falls below EDIFF
+        expected = sorted(scf)[len(scf) // 2] if scf else None
+        scf_left = self._steps_to(scf_d_e[-self.TREND:], ediff)
+        if scf_left is None and expected is not None:
+            scf_left = max(0, expected - current)
+        if static:
+            ionic_left = 0
+        else:
+            # force criterion for a negative EDIFFG, energy criterion otherwise
+            if ediffg < 0:
+                ionic_left = self._steps_to(forces[-self.TREND:], -ediffg)
+            else:
+                ionic_left = self._steps_to([d_e] if d_e is not None else [], ediffg)
+            bound = max(0, nsw - ionic)
+            ionic_left = bound if ionic_left is None else min(ionic_left, bound)
+
+        t_scf, t_ionic = self._mean(loop), self._mean(loop_)
+        if t_ionic is None and t_scf is not None and expected is not None:
+            t_ionic = t_scf * expected
+        eta = None
+        if t_scf is not None and scf_left is not None and (ionic_left == 0 or t_ionic is not None):
+            eta = scf_left * t_scf + ionic_left * (t_ionic or 0)
+        return {
+            "step": self.step,
+            "ionic": ionic,
+            "nsw": nsw,
+            "scf": scf[-self.TREND:],
+            "current_scf": current,
+            "dE": d_e,
+            "forces": forces[-self.TREND:],
+            "eta": eta,
+        }
+
+
+def _job_progress(job_id, root: SPath, name):
+    # the step of a per-step job is in its script name, a whole flow runs its first open step
+    step = WorkflowParser.step_of(name) if name.count(".") > 1 else None
+    if step not in WORKFLOW:
+        try:
+            step = next(iter(RunningRoot(root).get_crun_workflow()), None)
+        except (FileNotFoundError, ValueError):
+            step = None
+    progress = {"job_id": job_id, "root": str(root), "step": step}
+    if step is not None and (root / step).exists():
+        progress.update(StepProgress(root / step).read())
+    return progress
+
+
+def _known(val):
+    return val is not None and str(val) not in ("?", "nan", "None", "")
+
+
+def running_jobs():
+    # (job id, work dir, script name) of every running job, a bundle gives one per member and a
+    # chain of per-step jobs maps each id to its own script
+    running, all_jobs = RUNNING_JOB_LOG.csv, ALL_JOB_LOG.csv
+    if running is None or running.empty:
+        return []
+    roots = {}
+    if all_jobs is not None:
+        for ids, root, names in zip(all_jobs["JOBID"], all_jobs["WORKDIR"], all_jobs["NAME"]):
+            if not _known(ids):
+                continue
+            ids, names = normalize_key(ids).split(":"), str(names).split(":")
+            for i, job_id in enumerate(ids):
+                name = names[i] if len(names) == len(ids) else ":".join(names)
+                roots.setdefault(job_id, []).append((SPath(str(root)), name))
+    jobs = []
+    for _, row in running.loc[running["ST"] == "R"].iterrows():
+        job_id = normalize_key(row["JOBID"])
+        members = roots.get(job_id)
+        if members is None and _known(row.get("WORKDIR")):
+            # a job from outside this campaign, yhcontrol recorded its directory
+            members = [(SPath(str(row["WORKDIR"])), str(row["NAME"]))]
+        jobs.extend((job_id, root, name) for root, name in members or [])
+    return jobs
+
+
+def running_progress(workers=32):
+    jobs = running_jobs()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda job: _job_progress(*job), jobs))
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+
+from calculation.vasp.inputs import POSCAR
+from calculation.vasp.outputs import OUTCAR, OSZICAR
+from calculation.vasp.analysis.cost import CostEstimator
+from config import WORKFLOW
+from utils import TH_LOCAL
+from utils.spath import SPath
+from utils.lazy import lazy_import
+
+np = lazy_import("numpy")
+
+WALLTIME_MODEL = TH_LOCAL / "walltime.json"
+
+
+class StepRecord:
+    def __init__(self, step_dir: SPath, estimator: CostEstimator = None):
+        self.step_dir = step_dir
+        self.step = step_dir.name
+        self.estimator = estimator if estimator is not None else CostEstimator()
+
+    def read(self):
+        # features as predict_structure builds them before submission, from the structure file
+        # of the root, the INCAR template and the k-mesh. NKPTS, ENCUT and ISPIN of the finished
+        # step differ from those and would not describe what a prediction sees. A copied step
+        # without its root falls back to its POSCAR, the atoms are the same
+        status = OUTCAR(self.step_dir / "OUTCAR").status()
+        if not status["finished"]:
+            return None
+        elapsed = status["elapsed"]
+        if elapsed is None:
+            return None
+        structure = self.estimator.find_structure(self.step_dir.parent) or \
+            self.step_dir / "POSCAR"
+        record = self.estimator.features(POSCAR.from_file(structure), self.step)
+        record.update({
+            "step": self.step,
+            "ionic": max(1, len(OSZICAR(self.step_dir / "OSZICAR"))),
+            "elapsed": float(elapsed),
+        })
+        return record
+
+
+def collect_records(roots, workflow=None):
+    if workflow is None:
+        workflow = WORKFLOW
+    estimator = CostEstimator(workflow)
+    records = []
+    for root in roots:
+        for step in workflow:
+            step_dir = root / step
+            if not (step_dir / "OUTCAR").exists():
+                continue
+            try:
+                record = StepRecord(step_dir, estimator).read()
+            except (FileNotFoundError, StopIteration, ValueError, IndexError):
+                continue
+            if record is not None:
+                records.append(record)
+    return records
+
+
+class WalltimeModel:
+    GLOBAL = "*"
+    MIN_SAMPLES = 8
+
+    def __init__(self, params=None, z=1.645, floor=600):
+        self.params = params if params is not None else {}
+        self.z = z
+        self.floor = floor
+
+    @staticmethod
+    def _design(features):
+        return [1.0, np.log(features["natoms"]), np.log(max(features["nkpt"], 1)),
+                np.log(features["encut"] / 400), float(features["ispin"] > 1),
+                float(features["nspecies"])]
+
+    @staticmethod
+    def _fit(records):
+        # time per ionic step from the cell, the ionic step count as its own statistic
+        x = np.array([WalltimeModel._design(r) for r in records])
+        y = np.log([r["elapsed"] / r["ionic"] for r in records])
+        coef, *_ = np.linalg.lstsq(x, y, rcond=None)
+        resid = y - x.dot(coef)
+        dof = max(len(records) - x.shape[1], 1)
+        return {
+            "coef": coef.tolist(),
+            "sigma": float(np.sqrt(np.sum(resid ** 2) / dof)),
+            "ionic": float(np.percentile([r["ionic"] for r in records], 75)),
+            "n": len(records),
+        }
+
+    @classmethod
+    def fit(cls, records, **kwargs):
+        if not records:
+            raise ValueError("no finished step found!")
+        params = {cls.GLOBAL: cls._fit(records)}
+        for step in {r["step"] for r in records}:
+            samples = [r for r in records if r["step"] == step]
+            if len(samples) >= cls.MIN_SAMPLES:
+                params[step] = cls._fit(samples)
+        return cls(params, **kwargs)
+
+    def predict(self, step, features, upper=True):
+        para = self.params.get(step, self.params[self.GLOBAL])
+        mu = float(np.dot(para["coef"], self._design(features)))
+        if upper:
+            mu += self.z * para["sigma"]
+        return max(self.floor, float(np.exp(mu) * para["ionic"]))
+
+    def predict_structure(self, root: SPath, steps=None):
+        estimator = CostEstimator()
+        if steps is None:
+            steps = list(estimator.workflow.keys())
+        structure = estimator.find_structure(root)
+        if structure is None:
+            return None
+        stru = POSCAR.from_file(structure)
+        return {step: self.predict(step, estimator.features(stru, step)) for step in steps}
+
+    def save(self, path: SPath = WALLTIME_MODEL):
+        path.write_text(json.dumps({"z": self.z, "floor": self.floor, "params": self.params},
+                                   indent=2))
+
+    @classmethod
+    def load(cls, path: SPath = WALLTIME_MODEL):
+        if not path.exists():
+            return None
+        data = json.loads(path.read_text())
+        return cls(data["params"], z=data["z"], floor=data["floor"])
+
+
+if __name__ == '__main__':
+    pass
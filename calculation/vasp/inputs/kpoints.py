@@ -5,12 +5,14 @@
 from enum import Enum
 import re
 
-import seekpath
-import numpy as np
 from utils.spath import SPath
+from utils.lazy import lazy_import
 from utils.tools import smart_fmt
 from calculation.vasp.inputs import POSCAR
 
+np = lazy_import("numpy")
+seekpath = lazy_import("seekpath")
+
 
 class KPOINTSModes(Enum):
     Gamma = 1
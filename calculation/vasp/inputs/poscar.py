@@ -1,14 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import numpy as np
 from collections import OrderedDict
 
-import spglib as spg
-
 from config import HUBBARD_U
 from utils.spath import SPath
 from utils.tools import smart_fmt
+from utils.lazy import lazy_import
+
+np = lazy_import("numpy")
+spg = lazy_import("spglib")
 
 ELEMENTS = {
     1: "H",
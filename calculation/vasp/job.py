@@ -1,19 +1,24 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import re
+import os
 from collections import OrderedDict
 from calculation.vasp.outputs import OUTCAR, OSZICAR
 from calculation.vasp.inputs import INCAR, KPOINTS, POSCAR, POTCAR, KPOINTSModes
-from calculation.vasp.workflow import ErrType
+from calculation.vasp.workflow import ErrType, WorkflowParser
 from config import WORKFLOW, CONDOR, INCAR_TEMPLATE
 from utils.spath import SPath
-from utils import ALL_JOB_LOG
-from utils.tools import smart_fmt
+from utils import ALL_JOB_LOG, ALL_JOB_LOCK
+from utils.tools import smart_fmt, FileLock
+
+# exit codes of vasp.py check, the job script leaves the try loop on CHECK_CONVERGED
+CHECK_CONVERGED = 0
+CHECK_NOT_CONVERGED = 1
 
 
 class VaspRunningJob:
-    def __init__(self, calc_dir: SPath):
+    def __init__(self, calc_dir: SPath, job_id=None):
         self.calc_dir = calc_dir.absolute()
+        self._job_id = job_id
         self._name = self.calc_dir.parent.name
         self._poscar = self.calc_dir / "POSCAR"
         self._contcar = self.calc_dir / "CONTCAR"
@@ -21,26 +26,41 @@ class VaspRunningJob:
         self._kpoints = self.calc_dir / "KPOINTS"
         self._outcar = self.calc_dir / "OUTCAR"
         self._oszicar = self.calc_dir / "OSZICAR"
-        self._incar = self.calc_dir / "INCAR"
         self._potcar = self.calc_dir / "POTCAR"
         self._running = self.calc_dir / "running"
         self._jtype = self.calc_dir.name
         self._spin = self.calc_dir / "is_spin.txt"
         self._converge = self.calc_dir / "converge.txt"
         self._ignore = self.calc_dir / "ignore.txt"
+        self._inputs = {}
 
-    def is_spin(self):
-        final_mag = OSZICAR(self._oszicar).final_mag
+    def _input(self, cls, path: SPath):
+        # parsed inputs are kept between the tries of vasp.py execute
+        if path not in self._inputs:
+            self._inputs[path] = cls.from_file(path)
+        return self._inputs[path]
+
+    @property
+    def converged(self):
+        return self._converge.exists()
+
+    @property
+    def ignored(self):
+        return self._ignore.exists()
+
+    def _mark_spin(self, final_mag):
         if final_mag is not None:
             if abs(final_mag) > 0.004:
                 self._spin.write_text(str(final_mag))
                 return True
         return False
 
-    def is_converge(self):
-        result = OUTCAR(self._outcar)
-        if result.finished():
-            if result.converged() or INCAR.from_file(self._incar).get("ISIF") != 3:
+    def is_spin(self):
+        return self._mark_spin(OSZICAR(self._oszicar).final_mag)
+
+    def _mark_converge(self, finished, converged):
+        if finished:
+            if converged or self._input(INCAR, self._incar).get("ISIF") != 3:
                 self._converge.touch()
                 return True
         if not self._ignore.exists():
@@ -49,31 +69,74 @@ class VaspRunningJob:
                 self._ignore.touch()
         return False
 
+    def is_converge(self):
+        status = OUTCAR(self._outcar).status()
+        return self._mark_converge(status["finished"], status["finished"] and status["converged"])
+
+    def check(self, yhrun_rc=0):
+        # errors, converge and spin of one try. Errors come from the bytes not scanned yet in
+        # this try, converge from the OUTCAR tail and spin from the parsed OSZICAR
+        scanner = ErrType(job_id=None, running_dir=self.calc_dir)
+        errors = []
+        for err_type, err_code, _ in scanner.errors():
+            if (err_type, err_code) not in errors:
+                errors.append((err_type, err_code))
+        status = OUTCAR(self._outcar).status() if self._outcar.exists() else {}
+
+        try:
+            # the job id is only needed to clean up after some errors
+            scanner.job_id = self.job_id if errors else None
+            scanner.correct(errors)
+        except Exception as err:
+            print(f"[...]error correction failed: {err!r}")
+        # the reactions rewrite inputs on disk, without errors CONTCAR replaced POSCAR
+        if errors:
+            self._inputs.clear()
+        else:
+            self._inputs.pop(self._poscar, None)
+
+        # a failed or killed yhrun did not finish this try, whatever the OUTCAR of an earlier
+        # try says. The step is not marked converged, ignore_error still applies
+        finished = yhrun_rc == 0 and status.get("finished")
+        converged = self._mark_converge(finished, status.get("converged"))
+        if not converged:
+            print(f"[...]not converged, {len(errors)} errors found")
+            return CHECK_NOT_CONVERGED
+        try:
+            final_mag = OSZICAR(self._oszicar).final_mag
+        except (FileNotFoundError, IndexError, AttributeError):
+            # no OSZICAR, no ionic step or steps not numbered 1..n
+            final_mag = None
+        self._mark_spin(final_mag)
+        print(f"[...]converged, {len(errors)} errors found, final mag: {final_mag}")
+        return CHECK_CONVERGED
+
     def is_finish(self):
         return OUTCAR(self._outcar).finished()
 
     @property
     def job_id(self):
-        _id = self.get_job_id_from_log()
+        # sibling steps of a per-step chain run at the same time, only the job itself knows
+        # which of them it is
+        if self._job_id:
+            return self._job_id
+        _id = os.environ.get("SLURM_JOB_ID") or self.get_job_id_from_log()
         if _id is not None:
             return _id
-        job_ids = self.get_job_ids_from_slurm_file()
-        if job_ids:
-            return max(job_ids)
-        raise FileNotFoundError("Slurm log not found!")
-
-    def get_job_ids_from_slurm_file(self):
-        slurm_ids = []
-        regex = re.compile(r"\d+")
-        for file in self.calc_dir.parent.rglob("slurm*.out"):
-            slurm_ids.extend(
-                regex.findall(file.name)
-            )
-        return [int(i) for i in slurm_ids]
+        raise FileNotFoundError("job id of this step not found!")
 
     def get_job_id_from_log(self):
-        if ALL_JOB_LOG.contain("WORKDIR", self.calc_dir):
-            return ALL_JOB_LOG.get("WORKDIR", self.calc_dir)["JOBID"]
+        # the row of the structure, a per-step chain lists one id per step script
+        root = self.calc_dir.parent
+        if not ALL_JOB_LOG.contain("WORKDIR", root):
+            return None
+        row = ALL_JOB_LOG.get("WORKDIR", root).iloc[0]
+        job_ids, names = str(row["JOBID"]).split(":"), str(row["NAME"]).split(":")
+        if len(job_ids) == 1:
+            return job_ids[0] if job_ids[0] not in ("", "?", "nan") else None
+        for job_id, name in zip(job_ids, names):
+            if WorkflowParser.step_of(name) == self._jtype:
+                return job_id
         return None
 
     def automatic_check_errors(self):
@@ -168,6 +231,7 @@ class VaspRunningJob:
             kpoints = KPOINTS(style=self.ktype)
             kpoints.get_kmesh(stru, kval_)
         kpoints.write(self._kpoints)
+        self._inputs[self._kpoints] = kpoints
 
     def get_inputs_file(self):
         self._inherit_from_parent()
@@ -191,6 +255,7 @@ class VaspRunningJob:
                     for lb, v in hubbard_u.items():
                         incar[lb] = v
         incar.write(self._incar)
+        self._inputs.update({self._incar: incar, self._poscar: stru})
 
         if not self._potcar.exists():
             potcar_lib = CONDOR.get("VASP", "PSEUDO_POTENTIAL_DIR")
@@ -210,13 +275,13 @@ class VaspRunningJob:
         times = self._get_idx()
         if times is not None:
             try:
-                self._write_kpt(stru=POSCAR.from_file(self._poscar),
+                self._write_kpt(stru=self._input(POSCAR, self._poscar),
                                 kval_=self.kpara[times])
                 uip = self.incar_[times]
             except IndexError:
                 return
             else:
-                incar = INCAR.from_file(self._incar)
+                incar = self._input(INCAR, self._incar)
                 for key, val in uip.items():
                     incar[key] = val
                 incar.write(self._incar)
@@ -255,8 +320,9 @@ class RunningRoot:
             for lb, val in self._results().items():
                 if not val:
                     alter_val += f"{lb},"
-        tmp = ALL_JOB_LOG.alter_("WORKDIR", self._root, alter_lb="RESULT", alter_val=alter_val)
-        ALL_JOB_LOG.apply_(tmp)
+        with FileLock(ALL_JOB_LOCK):
+            tmp = ALL_JOB_LOG.alter_("WORKDIR", self._root, alter_lb="RESULT", alter_val=alter_val)
+            ALL_JOB_LOG.apply_(tmp)
 
         return alter_val
 
@@ -1,40 +1,96 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import re
 
 from utils.spath import SPath
 from utils.tools import smart_fmt
+from utils.lazy import lazy_import
+
+np = lazy_import("numpy")
 
 
 class OSZICAR:
+    FIELDS = ("F", "E0", "dE", "mag")
+    _regex = re.compile(r"(\d+\s|-?\d*.?\d+[E]?[+|-]?\d+)")
+    # an electronic step line, e.g. DAV:   1    -0.1E+01   -0.1E+01   -0.1E+01  1000   0.1E+01
+    _electronic = re.compile(r"^\s*[A-Za-z]+\s*:\s*\d")
+
     def __init__(self, oszicar: SPath):
         self.oszicar = oszicar
+        self._stat = None
+        self._arrays = None
 
     def __len__(self):
-        return len(self.read())
+        return len(self.arrays["step"])
 
     def __getitem__(self, item):
-        return self.read()[item]
+        arrays = self.arrays
+        idx = range(len(arrays["step"]))[item]
+        if isinstance(idx, range):
+            return [self._step(arrays, i) for i in idx]
+        return self._step(arrays, idx)
 
-    def read(self):
-        steps, idx = [], 1
-        regex = re.compile(r"(\d+\s|-?\d*.?\d+[E]?[+|-]?\d+)")
+    @classmethod
+    def _step(cls, arrays, i):
+        values = {k: arrays[k][i].item() for k in cls.FIELDS if not np.isnan(arrays[k][i])}
+        return {arrays["step"][i].item(): values}
+
+    def _parse(self):
+        steps, values, scf, count = [], [], [], 0
         for line in self.oszicar.readline_text():
-            if "F=" in line:
-                p = regex.findall(line)
-                idx, *p = [smart_fmt(i) for i in p]
-                h = ["F", "E0", "dE", "mag"]
-                steps.append(
-                    {
-                        idx: dict(zip(h, p))
-                    }
-                )
-        return steps
+            step = self.parse_line(line)
+            if step is None:
+                if self.is_electronic_line(line):
+                    count += 1
+                continue
+            (idx, fields), = step.items()
+            steps.append(idx)
+            values.append([fields.get(k, np.nan) for k in self.FIELDS])
+            scf.append(count)
+            count = 0
+        values = np.array(values, dtype=float).reshape(-1, len(self.FIELDS))
+        arrays = {k: values[:, i] for i, k in enumerate(self.FIELDS)}
+        arrays["step"] = np.array(steps, dtype=int)
+        arrays["scf"] = np.array(scf, dtype=int)
+        return arrays
+
+    @property
+    def arrays(self):
+        # one array per ionic step field plus the electronic steps of each ionic step, parsed
+        # again only when the file changed
+        st = os.stat(self.oszicar)
+        stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if stat != self._stat:
+            self._arrays, self._stat = self._parse(), stat
+        return self._arrays
+
+    def read(self):
+        return self[:]
+
+    @classmethod
+    def is_electronic_line(cls, line):
+        return cls._electronic.match(line) is not None
+
+    @classmethod
+    def parse_line(cls, line):
+        # an ionic step line, e.g. 1 F= -.1E+02 E0= -.1E+02  d E =-.1E+02  mag=     2.0
+        if "F=" not in line:
+            return None
+        p = cls._regex.findall(line)
+        idx, *p = [smart_fmt(i) for i in p]
+        h = ["F", "E0", "dE", "mag"]
+        return {idx: dict(zip(h, p))}
 
     @property
     def final_step(self):
-        return self.read()[-1].get(len(self))
+        # the last ionic step, None when the steps are not numbered 1..n
+        arrays = self.arrays
+        n = len(arrays["step"])
+        if n == 0:
+            raise IndexError("no ionic step in OSZICAR")
+        return self._step(arrays, n - 1).get(n)
 
     @property
     def final_E0(self):
@@ -1,34 +1,78 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import re
+import mmap
+
 from utils.spath import SPath
 from utils.tools import smart_fmt
+from utils.lazy import lazy_import
 
-from pymatgen.io.vasp.outputs import Outcar
+vasp_outputs = lazy_import("pymatgen.io.vasp.outputs")
 
 
 class OUTCAR:
+    FINISHED = "General timing and accounting informations for this job"
+    CONVERGED = "reached required accuracy - stopping structural energy minimisation"
+    # the markers sit in the last few kB of a finished run, a window keeps a stopped multi-GB
+    # OUTCAR from being read end to end
+    TAIL_WINDOW = 1 << 20
+    _ionic = re.compile(rb"Iteration\s+(\d+)\(")
+    _elapsed = re.compile(rb"Elapsed time \(sec\):\s*(\S+)")
+
     def __init__(self, outcar: SPath):
         self.outcar = outcar
 
-    def converged(self):
-        for line in self.outcar.readline_text_reversed():
-            if "reached required accuracy - stopping structural energy minimisation" in line:
-                return True
+    @staticmethod
+    def _last(mm, head: bytes, regex, start):
+        # the last match of regex at an occurrence of head, found with rfind
+        end = len(mm)
+        while True:
+            pos = mm.rfind(head, start, end)
+            if pos < 0:
+                return None
+            match = regex.match(mm, pos)
+            if match is not None:
+                return match.group(1).decode()
+            end = pos + len(head) - 1
+
+    def status(self, window=None, full=False):
+        # finished, converged, elapsed and the last ionic step from the mapped tail. The window
+        # is paged in once, the marker searches run on memory
+        status = {"finished": False, "converged": False, "elapsed": None, "ionic": None}
+        with open(self.outcar, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return status
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                start = 0 if full else max(0, size - (window or self.TAIL_WINDOW))
+                status["finished"] = mm.rfind(self.FINISHED.encode(), start) >= 0
+                status["converged"] = mm.rfind(self.CONVERGED.encode(), start) >= 0
+                elapsed = self._last(mm, b"Elapsed time", self._elapsed, start)
+                ionic = self._last(mm, b"Iteration", self._ionic, start)
+        status["elapsed"] = smart_fmt(elapsed) if elapsed is not None else None
+        status["ionic"] = int(ionic) if ionic is not None else None
+        return status
+
+    def converged(self, full=False):
+        return self.status(full=full)["converged"]
 
-        return False
+    def finished(self, full=False):
+        return self.status(full=full)["finished"]
 
-    def finished(self):
-        for line in self.outcar.readline_text_reversed():
-            if "General timing and accounting informations for this job" in line:
-                return True
+    def elapsed(self, full=False):
+        return self.status(full=full)["elapsed"]
 
-        return False
+    def nkpts(self):
+        for line in self.outcar.readline_text():
+            if "NKPTS =" in line:
+                return smart_fmt(line.split("NKPTS =")[1].split()[0])
+        return None
 
     @property
     def data(self):
-        return Outcar(str(self.outcar))
+        return vasp_outputs.Outcar(str(self.outcar))
 
 
 if __name__ == '__main__':
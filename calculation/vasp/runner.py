@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import subprocess
+import traceback
+
+from calculation.vasp.job import VaspRunningJob, RunningRoot, CHECK_CONVERGED
+from calculation.vasp.workflow import WorkflowParser
+from utils.spath import SPath
+
+
+class WorkflowRunner:
+    # the steps of WorkflowParser.parser run in one python process inside the allocation
+    def __init__(self, root: SPath, workflow=None, exclusive=False):
+        self.root = root.absolute()
+        if workflow is None:
+            workflow = RunningRoot(self.root).get_crun_workflow()
+        self.parser = WorkflowParser(work_root=self.root, workflow=workflow, exclusive=exclusive)
+        self._stat = self.root / "stat.log"
+
+    @staticmethod
+    def _call(func, *args):
+        # a failing helper does not stop the step, as with the python calls of the bash flow
+        try:
+            return func(*args)
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    def _record(self, step, result):
+        with open(self._stat, "a") as f:
+            f.write(f"{step}\t {result}\n")
+
+    def _yhrun(self, step_dir: SPath, node, core):
+        # appended like the bash flow does, the error checkpoint skips the earlier tries
+        with open(step_dir / "yh.log", "a") as log:
+            return subprocess.call(self.parser.yhrun_prog(node, core), shell=True,
+                                   cwd=str(step_dir), stdout=log)
+
+    def run_step(self, step, paras):
+        print(f"[...]start {step} task")
+        step_dir = self.root / step
+        step_dir.mkdir(exist_ok=True)
+        node, core = self.parser.resources(paras)
+        try_num = paras.get("try_num") or 1
+        job = VaspRunningJob(step_dir)
+        print(f"[...]prepare {step} inputs.")
+        self._call(job.get_inputs_file)
+        for try_ in range(1, try_num + 1):
+            print(f"[...]task {step} round: {try_} on {node} node {core} core")
+            rc = self._yhrun(step_dir, node, core)
+            if rc == 0:
+                print(f"[...]calc step: {try_} completed!")
+                print("[...]check calculation result...")
+            else:
+                print("[...]yhrun command failed! check errors")
+            if self._call(job.check, rc) == CHECK_CONVERGED:
+                break
+            print("[...]calculation not done, prepare to next loop")
+            self._call(job.update_input_files)
+
+        if job.converged:
+            print(f"[...]{step} job done!")
+        elif job.ignored:
+            print("[...]errors can be ignored, preparing for the next calculation")
+            self._call(job.is_spin)
+        else:
+            print("[...]subsequent calculations are not allowed, job exits...")
+            self._record(step, "failed")
+            return False
+        self._record(step, "successed")
+        return True
+
+    def run(self, step=None):
+        steps = list(self.parser.yield_job())
+        if step is not None:
+            steps = [(name, paras) for name, paras in steps if name == step]
+        task = "TASK" if step is None else f"TASK {step}"
+        print(f"[...]{task} START!")
+        for name, paras in steps:
+            if not self.run_step(name, paras):
+                return False
+        print(f"[...]{task} DONE!")
+        return True
+
+    def summary(self):
+        return self._call(RunningRoot(self.root).summary)
+
+
+if __name__ == '__main__':
+    pass
@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
+import re
+import json
 import math
+import hashlib
 from enum import Enum, unique
 from utils.spath import SPath
 from calculation.vasp.inputs import INCAR, KPOINTS, KPOINTSModes
 from utils.yhurm import TianHeNodes, TianHeJob, RUNNING_JOB_LOG, TianHeWorker
-from utils import ALL_JOB_LOG
+from utils import ALL_JOB_LOG, BUNDLE_PREFIX, PILOT_SCRIPT
 from config import WORKFLOW, CONDOR
 
 
@@ -62,8 +66,53 @@ class Errors(Enum):
         return self.name
 
 
+class ErrorCatalogue:
+    # every keyword of Errors in one alternation, a file is read once for all of them
+    BLOCK = 1 << 24
+
+    def __init__(self, errors=Errors):
+        self._codes = {keyword: (e, code) for e in errors for code, keyword in e.value.items()}
+        # longest first, a keyword never loses to a shorter one starting at the same place
+        alternation = "|".join(re.escape(k) for k in sorted(self._codes, key=len, reverse=True))
+        self._text = re.compile(alternation)
+        self._bytes = re.compile(alternation.encode())
+
+    def match_line(self, line):
+        hits = []
+        for match in self._text.finditer(line):
+            hit = self._codes[match.group()]
+            if hit not in hits:
+                hits.append(hit)
+        return hits
+
+    def scan(self, path: SPath, offset=0):
+        # (error, code, byte offset of the line) hits from offset on and the offset after the
+        # last whole line. Blocks of whole lines are matched, a last line without its newline too
+        hits = []
+        with open(path, "rb") as f:
+            f.seek(offset)
+            rest, start = b"", offset
+            while True:
+                data = f.read(self.BLOCK)
+                buf = rest + data
+                cut = buf.rfind(b"\n") + 1 if data else len(buf)
+                for match in self._bytes.finditer(buf, 0, cut):
+                    e, code = self._codes[match.group().decode()]
+                    hit = (e, code, start + buf.rfind(b"\n", 0, match.start()) + 1)
+                    if not hits or hits[-1] != hit:
+                        hits.append(hit)
+                if not data:
+                    return hits, start
+                rest, start = buf[cut:], start + cut
+
+
 class ErrType:
     errorType = Errors
+    catalogue = ErrorCatalogue()
+    # scanned part of each file, kept across tries. yh.log grows, VASP rewrites OUTCAR and
+    # OSZICAR at the start of a try and the hashes tell the rewritten file apart
+    CHECKPOINT = ".errors.json"
+    HEAD = 4096
 
     def __init__(self, job_id, running_dir: SPath):
         self.job_id = job_id
@@ -77,6 +126,7 @@ class ErrType:
         self._poscar = self.running_root / "POSCAR"
         self._chgcar = self.running_root / "CHGCAR"
         self._wavecar = self.running_root / "WAVECAR"
+        self._checkpoint = self.running_root / self.CHECKPOINT
 
     @property
     def workflow_type(self):
@@ -111,22 +161,57 @@ class ErrType:
     def modify_potcar(self):
         raise NotImplementedError
 
-    @staticmethod
-    def _match(target_file: SPath):
-        for e in Errors:
-            for code, keyword in e.value.items():
-                for line in target_file.readline_text_reversed():
-                    if keyword in line:
-                        yield e, code
+    @classmethod
+    def match_line(cls, line):
+        return cls.catalogue.match_line(line)
 
-    def _yield_error(self):
+    def _digest(self, log: SPath, offset):
+        # the first bytes and the bytes before offset, a rewritten file differs in the banner
+        # (the OUTCAR date) or where its last scan ended
+        with open(log, "rb") as f:
+            head = f.read(min(offset, self.HEAD))
+            f.seek(max(0, offset - self.HEAD))
+            tail = f.read(min(offset, self.HEAD))
+        return hashlib.sha1(head + tail).hexdigest()
+
+    def _scan(self, log: SPath, marks):
+        # only the bytes after the last scan. Another inode, a shorter file or other bytes
+        # around the offset mean the file was replaced or rewritten, it is scanned from the start
+        st = os.stat(log)
+        mark = marks.get(log.name) or {}
+        offset = mark.get("offset", 0)
+        if mark.get("ino") != st.st_ino or st.st_size < offset or \
+                self._digest(log, offset) != mark.get("head"):
+            offset, mark = 0, {}
+        hits, end = self.catalogue.scan(log, offset)
+        marks[log.name] = {"ino": st.st_ino, "size": st.st_size, "offset": end,
+                           "head": self._digest(log, end),
+                           # a line without its newline is matched again by the next scan
+                           "partial": [code for _, code, line in hits if line == end]}
+        partial = mark.get("partial", [])
+        return [hit for hit in hits if not (hit[2] == offset and hit[1] in partial)]
+
+    def errors(self):
+        # new hits of yh.log, OUTCAR and OSZICAR since the last scan
+        try:
+            marks = json.loads(self._checkpoint.read_text())
+        except (FileNotFoundError, ValueError):
+            marks = {}
+        hits = []
         for log in [self.yh, self._outcar, self._oszicar]:
-            try:
-                matched = self._match(log)
-                if matched is not None:
-                    yield matched
-            except FileNotFoundError:
-                continue
+            if log.exists():
+                hits.extend(self._scan(log, marks))
+        tmp = self._checkpoint.with_name(f"{self.CHECKPOINT}.{os.getpid()}")
+        tmp.write_text(json.dumps(marks))
+        os.replace(tmp, self._checkpoint)
+        return hits
+
+    def _shared(self):
+        # a bundle or pilot allocation, its nodes run the VASP of sibling structures too
+        if not RUNNING_JOB_LOG.contain("JOBID", self.job_id):
+            return False
+        name = str(RUNNING_JOB_LOG.get("JOBID", self.job_id)["NAME"].iloc[0])
+        return name.startswith(BUNDLE_PREFIX) or name == PILOT_SCRIPT
 
     def reaction(self, err_type, err_code):
         if err_code == 1:
@@ -140,8 +225,10 @@ class ErrType:
             print(f"error type: {err_type.value}, "
                   f"need to be resolved manually, check inputs setting!")
             TianHeWorker(partition=CONDOR.get("ALLOW", "PARTITION"),
-                         total_allowed_node=CONDOR.getint("ALLOW", "TOTAL_NODE")).flush()
-            if RUNNING_JOB_LOG.contain("JOBID", self.job_id):
+                         total_allowed_node=CONDOR.getint("ALLOW", "TOTAL_NODE")).snapshot()
+            if self._shared():
+                print(f"[...]job {self.job_id} runs other structures too, nodes left alone")
+            elif RUNNING_JOB_LOG.contain("JOBID", self.job_id):
                 job_nodes = TianHeNodes(self.job_id)
                 try:
                     job_nodes.kill_zombie_process_on_nodes(key_word=CONDOR["VASP"]["VASP_EXE"])
@@ -234,19 +321,24 @@ class ErrType:
                 self.incar.write(self._incar)
 
     def automatic_error_correction(self):
-        el = False
-        for x in self._yield_error():
-            xl = list(x)
-            if xl:
-                el = True
-                for err_type, err_code in xl:
-                    self.reaction(err_type, err_code)
-        if not el:
+        errors = []
+        for err_type, err_code, _ in self.errors():
+            if (err_type, err_code) not in errors:
+                errors.append((err_type, err_code))
+        self.correct(errors)
+
+    def correct(self, errors):
+        if not errors:
             print("[...]error not found, update POSCAR if CONTCAR is not empty...")
             self.contcar2poscar()
+        for err_type, err_code in errors:
+            self.reaction(err_type, err_code)
 
     def get_error_from(self, log):
-        return self._match(log)
+        # the whole log, not only what the checkpoint of this try has not seen
+        hits, _ = self.catalogue.scan(log)
+        for err_type, err_code, _ in hits:
+            yield err_type, err_code
 
 
 if __name__ == '__main__':
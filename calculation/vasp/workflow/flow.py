@@ -1,14 +1,13 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import os
 from config import WORKFLOW, CONDOR, PACKAGE_ROOT
 from utils.spath import SPath
 
 
 class WorkflowParser:
     def __init__(self, work_root: SPath, comment=None, source=None,
-                 modules=None, workflow=None, prog=None, name=None):
+                 modules=None, workflow=None, prog=None, name=None, exclusive=False, runner=None):
         self.work_root = work_root.absolute()
         if comment is None:
             comment = "#!/bin/bash"
@@ -21,6 +20,10 @@ class WorkflowParser:
         self.workflow = workflow
         self._py = PACKAGE_ROOT / "vasp.py"
         self.name = name
+        self.exclusive = exclusive
+        if runner is None:
+            runner = CONDOR.get("RUNNER", "NAME", fallback="bash")
+        self.runner = runner
         if source is None:
             self.source = CONDOR.get('SOURCE', 'FILES')
             if self.source:
@@ -35,9 +38,21 @@ class WorkflowParser:
             yield job_name, job_paras
 
     def yhrun_prog(self, node, core):
-        return f"yhrun -N {node} -n {core} {CONDOR['VASP']['VASP_DIR']}/{self.prog}"
+        exclusive = " --exclusive" if self.exclusive else ""
+        return f"yhrun -N {node} -n {core}{exclusive} {CONDOR['VASP']['VASP_DIR']}/{self.prog}"
 
-    def parser(self, job_name, job_paras):
+    @staticmethod
+    def resources(job_paras):
+        node = job_paras.get("node")
+        core = job_paras.get("core")
+        if node is None:
+            node = 1
+            core = 24
+        if core is None:
+            core = 24 * node
+        return node, core
+
+    def parser(self, job_name, job_paras, fail_exit="exit"):
         flow = ''
         #task_dir = self.work_root / job_name
         task_dir =  SPath("./")
@@ -48,13 +63,7 @@ class WorkflowParser:
         flow += f"else\n"
         flow += f"  cd {job_name}\n"
         flow += f"fi\n"
-        node = job_paras.get("node")
-        core = job_paras.get("core")
-        if node is None:
-            node = 1
-            core = 24
-        if core is None:
-            core = 24 * node
+        node, core = self.resources(job_paras)
         try_num = job_paras.get("try_num")
         if try_num is None:
             try_num = 1
@@ -64,19 +73,18 @@ class WorkflowParser:
         flow += f"for ((try_num=1;try_num<={try_num};try_num++))\n"
         flow += "  do\n"
         flow += f"  echo \"[...]task {job_name} round: $try_num on {node} node {core} core\"\n"
-        flow += f"  {self.yhrun_prog(node, core)} > yh.log\n"
-        flow += f"  if [ $? -eq 0 ]; then\n"
+        # yh.log keeps every try, the error checkpoint skips the tries already checked
+        flow += f"  {self.yhrun_prog(node, core)} >> yh.log\n"
+        flow += f"  yhrun_rc=$?\n"
+        flow += f"  if [ $yhrun_rc -eq 0 ]; then\n"
         flow += f"    echo \"[...]calc step: $try_num completed!\"\n"
         flow += f"    echo \"[...]check calculation result...\"\n"
-        flow += f"    python {self._py} errors --work_dir {task_dir}\n"
-        flow += f"    python {self._py} converge --work_dir {task_dir}\n"
-        flow += f"    if [ -f \"{converge_txt}\" ];then\n"
-        flow += f"      python {self._py} spin --work_dir {task_dir}\n"
-        flow += f"      break\n"
-        flow += f"    fi\n"
         flow += f"  else\n"
         flow += f"    echo \'[...]yhrun command failed! check errors\'\n"
-        flow += f"    python {self._py} errors --work_dir {task_dir}\n"
+        flow += f"  fi\n"
+        flow += f"  if python {self._py} check --work_dir {task_dir} --yhrun_rc $yhrun_rc " \
+                f"--job_id \"$SLURM_JOB_ID\";then\n"
+        flow += f"    break\n"
         flow += f"  fi\n"
         flow += f"  echo \'[...]calculation not done, prepare to next loop\'\n"
         flow += f"  python {self._py} update --work_dir {task_dir}\n"
@@ -87,7 +95,7 @@ class WorkflowParser:
         flow += f"  if [ ! -f \"{ignore_txt}\" ];then\n"
         flow += f"    echo \'[...]subsequent calculations are not allowed, job exits...\'\n"
         flow += f"    echo '{job_name}\t failed' >> ../stat.log\n"
-        flow += f"    exit\n"
+        flow += f"    {fail_exit}\n"
         flow += f"  else\n"
         flow += f"    echo \'[...]errors can be ignored, preparing for the next calculation\'\n"
         flow += f"    python {self._py} spin --work_dir {task_dir}\n"
@@ -95,18 +103,31 @@ class WorkflowParser:
         flow += f"  fi\n"
         flow += f"else\n"
         flow += f"  echo \'[...]{job_name} job done!\'\n"
-        flow += f"  python {self._py} spin --work_dir {task_dir}\n"
         flow += f"  echo '{job_name}\t successed' >> ../stat.log\n"
         flow += f"fi\n"
         flow += f"cd ..\n"
 
         return flow
 
-    def _get(self):
+    def _head(self):
         b = ''
         b += f"{self.comment}\n"
         b += f"{self.source}\n"
         b += f"{self.module}\n"
+        return b
+
+    def _execute(self, step=None):
+        # python runner, see calculation.vasp.runner
+        b = self._head()
+        b += f"python -u {self._py} execute --root {self.work_root}"
+        b += " --exclusive" if self.exclusive else ""
+        b += "\n" if step is None else f" --step {step}\n"
+        return b
+
+    def _get(self):
+        if self.runner == "python":
+            return self._execute()
+        b = self._head()
         b += f"echo \'[...]TASK START!\'\n"
         for step, paras in self.yield_job():
             b += self.parser(step, paras)
@@ -114,12 +135,49 @@ class WorkflowParser:
         b += f"echo \'[...]TASK DONE!\'"
         return b
 
+    def _get_step(self, step, paras):
+        if self.runner == "python":
+            return self._execute(step)
+        summary = f"python {self._py} summary --root {self.work_root}"
+        b = self._head()
+        b += f"echo \'[...]TASK {step} START!\'\n"
+        b += self.parser(step, paras, fail_exit=f"{summary}; exit 1")
+        b += f"{summary}\n"
+        b += f"echo \'[...]TASK {step} DONE!\'"
+        return b
+
     def write_sh(self):
         filename = self.work_root.name + ".sh"
         sh_path = self.work_root / filename
         sh_path.write_text(self._get())
         return self.work_root, filename
 
+    def write_bundle_sh(self, members, filename):
+        b = self._head()
+        b += f"echo \'[...]BUNDLE START!\'\n"
+        for root, name in members:
+            b += f"(cd {root} && bash {name} > slurm-$SLURM_JOB_ID.out 2>&1) &\n"
+        b += "wait\n"
+        b += f"echo \'[...]BUNDLE DONE!\'"
+        sh_path = self.work_root / filename
+        sh_path.write_text(b)
+        return self.work_root, filename
+
+    @staticmethod
+    def step_of(filename):
+        return filename.rsplit(".", 2)[-2]
+
+    def write_step_sh(self):
+        filenames = []
+        for step, paras in self.yield_job():
+            filename = f"{self.work_root.name}.{step}.sh"
+            sh_path = self.work_root / filename
+            sh_path.write_text(self._get_step(step, paras))
+            filenames.append(filename)
+        if not filenames:
+            return self.work_root, None
+        return self.work_root, ":".join(filenames)
+
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from calculation.vasp.job import VaspRunningJob, CHECK_NOT_CONVERGED
+from calculation.vasp.workflow import ErrType
+from config import WORKFLOW
+from utils.spath import SPath
+
+
+def _outcar(date, error):
+    return f" vasp.6.3.0 (build {date}) complex\n running on 24 total cores\n {error}\n"
+
+
+def test_second_try_reports_only_new_errors(tmp_path, monkeypatch):
+    step_dir = SPath(tmp_path / "c0" / next(iter(WORKFLOW)))
+    step_dir.mkdir(parents=True)
+    seen = []
+    monkeypatch.setattr(ErrType, "correct", lambda self, errors: seen.append(errors))
+    job = VaspRunningJob(step_dir, job_id="1000")
+
+    # the first try, yh.log is appended by every try
+    with open(step_dir / "yh.log", "a") as f:
+        f.write(" please rerun with smaller EDIFF\n")
+    (step_dir / "OUTCAR").write_text(_outcar("Jan 01 2026 10:00:00", "Hard potentials"))
+    assert job.check(1) == CHECK_NOT_CONVERGED
+
+    # the second try, VASP rewrites OUTCAR in place with as many bytes as before
+    with open(step_dir / "yh.log", "a") as f:
+        f.write(" integer divide by zero\n")
+    ino = (step_dir / "OUTCAR").stat().st_ino
+    with open(step_dir / "OUTCAR", "r+") as f:
+        f.truncate(0)
+        f.write(_outcar("Jan 02 2026 11:00:00", "Hard potentials"))
+    assert (step_dir / "OUTCAR").stat().st_ino == ino
+    assert job.check(1) == CHECK_NOT_CONVERGED
+
+    first, second = [{code for _, code in errors} for errors in seen]
+    assert first == {1, 3}
+    assert second == {7, 3}
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from utils import ALL_JOB_LABEL
+from utils.log import LogCsv
+from utils.store import JobStore
+from utils.journal import JournalLog, normalize_key
+from utils.spath import SPath
+
+# every [LOG] BACKEND of condor.ini, all keep the TSV next to them
+BACKENDS = {
+    "csv": lambda d: LogCsv(SPath(d / "all_job.csv")),
+    "sqlite": lambda d: JobStore(SPath(d / "all_job.db"), SPath(d / "all_job.csv")),
+    "journal": lambda d: JournalLog(SPath(d / "all_job.journal"), SPath(d / "all_job.csv")),
+}
+
+
+@pytest.fixture(params=list(BACKENDS))
+def log(request, tmp_path):
+    return BACKENDS[request.param](tmp_path)
+
+
+def _touch(log):
+    log.touch(ALL_JOB_LABEL, [["", "PD", f"/w/{name}", f"{name}.sh", ""] for name in "abc"])
+
+
+def test_missing_file(log):
+    assert log.csv is None
+    assert not log.contain("JOBID", 1234)
+    assert log.get("WORKDIR", "/w/a") is None
+
+
+def test_touch(log):
+    _touch(log)
+    assert log.csv["WORKDIR"].tolist() == ["/w/a", "/w/b", "/w/c"]
+    assert log.csv["ST"].tolist() == ["PD"] * 3
+    assert log.contain("WORKDIR", SPath("/w/b"))
+    assert not log.contain("WORKDIR", "/w/d")
+
+
+def test_alter_batch_apply(log):
+    _touch(log)
+    log.apply_(log.alter_batch("WORKDIR", [("/w/a", {"JOBID": "1234", "ST": "SS"}),
+                                           (SPath("/w/b"), {"JOBID": 1235, "ST": "SS"})]))
+    assert log.csv["ST"].tolist() == ["SS", "SS", "PD"]
+    assert log.get("WORKDIR", "/w/c")["NAME"].tolist() == ["c.sh"]
+    assert log.get("WORKDIR", "/w/d").empty
+
+
+def test_jobid_types(log):
+    _touch(log)
+    log.apply_(log.alter_batch("WORKDIR", [("/w/a", {"JOBID": "1234"}),
+                                           ("/w/b", {"JOBID": 1235}),
+                                           ("/w/c", {"JOBID": "1236:1237"})]))
+    # read back as LogCsv reads its TSV, an id of a str or an int finds the same row
+    assert [normalize_key(i) for i in log.csv["JOBID"]] == ["1234", "1235", "1236:1237"]
+    for job_id, root in (("1234", "/w/a"), (1234, "/w/a"), ("1235", "/w/b"), (1235, "/w/b"),
+                         ("1236:1237", "/w/c")):
+        assert log.contain("JOBID", job_id)
+        assert log.get("JOBID", job_id)["WORKDIR"].tolist() == [root]
+    assert not log.contain("JOBID", 1236)
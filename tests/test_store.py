@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from utils import ALL_JOB_LABEL
+from utils.spath import SPath
+from utils.store import JobStore
+from utils.journal import normalize_key
+
+
+def test_jobid_round_trip_with_null(tmp_path):
+    store = JobStore(SPath(tmp_path / "all_job.db"))
+    store.touch(ALL_JOB_LABEL, [["", "PD", "/w/a", "a.sh", ""],
+                                ["", "PD", "/w/b", "b.sh", ""]])
+    store.apply_(store.alter_batch("WORKDIR", [("/w/a", {"JOBID": "1234", "ST": "SS"})]))
+
+    csv = store.csv
+    job_ids = [str(i) for i in csv["JOBID"]]
+    assert job_ids == ["1234", "?"]
+    assert normalize_key(store.get("WORKDIR", "/w/a")["JOBID"].iloc[0]) == "1234"
+    assert store.contain("JOBID", 1234) and store.contain("JOBID", "1234")
@@ -1,22 +1,35 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from .log import LogCsv
+from functools import partial
+
+from .log import open_log
+from .lazy import LazyObject
 from .spath import SPath
 
 PROG_ROOT = SPath(__file__).parent.parent
 TH_LOCAL = PROG_ROOT / ".local"
 TH_LOCAL.mkdir(exist_ok=True)
+TH_BUNDLE = TH_LOCAL / "bundle"
+# job scripts running several structures in one allocation
+BUNDLE_PREFIX = "bundle_"
+PILOT_SCRIPT = "pilot.sh"
 
 YHQ_LABEL = ["JOBID", "PARTITION", "NAME", "USER", "ST", "TIME", "NODE", "NODELIST(REASON)"]
 YHI_LABEL = ["CLASS", "ALLOC", "IDLE", "DRAIN", "TOTAL"]
-RUNNING_JOB_LOG = LogCsv(SPath(TH_LOCAL / "running_job.csv"))
-HPC_LOG = LogCsv(SPath(TH_LOCAL / "hpc.csv"))
+YHQ_COLUMN = ["JOBID", "PARTITION", "NAME", "USER", "ST", "TIME", "NODES", "NODELIST(REASON)"]
+YHQ_FORMAT = "%i|%P|%j|%u|%t|%M|%D|%R"
+YHI_FORMAT = "%R|%F"
+# LogCsv or JobStore, picked on first use
+RUNNING_JOB_LOG = LazyObject(partial(open_log, SPath(TH_LOCAL / "running_job.csv")))
+HPC_LOG = LazyObject(partial(open_log, SPath(TH_LOCAL / "hpc.csv")))
 TEMP_FILE = SPath(TH_LOCAL / "tmp.txt")
-ALL_JOB_LOG = LogCsv(SPath(TH_LOCAL / "all_job.csv"))
+ALL_JOB_LOG = LazyObject(partial(open_log, SPath(TH_LOCAL / "all_job.csv")))
 ALL_JOB_LABEL = ["JOBID", "ST", "WORKDIR", "NAME", "RESULT"]
+# held by job scripts and pilots while they rewrite ALL_JOB_LOG
+ALL_JOB_LOCK = TH_LOCAL / "all_job.write.lock"
 ERROR_JOB_LABEL = ["JOB_PATH", "ERROR_CODE", "ERROR_NAME"]
-ERROR_JOB_LOG = LogCsv(SPath(TH_LOCAL / "error_job.csv"))
+ERROR_JOB_LOG = LazyObject(partial(open_log, SPath(TH_LOCAL / "error_job.csv")))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import signal
+import threading
+import subprocess
+
+from utils import TH_LOCAL, RUNNING_JOB_LOG, HPC_LOG, YHQ_COLUMN
+from utils.yhurm import TianHeTime
+from config import CONDOR
+
+TH_LOCAL_BIN = TH_LOCAL / "bin"
+
+
+class Backend:
+    # answers the yh* commands utils.yhurm issues, see utils.yhurm.use_scheduler
+    def run(self, cmd):
+        cwd = os.getcwd()
+        if "&&" in cmd:
+            prefix, cmd = cmd.rsplit("&&", 1)
+            if prefix.strip().startswith("cd "):
+                cwd = prefix.strip()[3:].strip()
+        # the fixed --format strings carry no spaces, a plain split is enough
+        args = cmd.split()
+        handler = getattr(self, f"_{args[0]}", None)
+        if handler is None:
+            return 127, f"{args[0]}: command not found"
+        return handler(args[1:], cwd)
+
+    async def arun(self, cmd):
+        return self.run(cmd)
+
+    def wait(self):
+        pass
+
+    @staticmethod
+    def _batch_args(args):
+        paras = {"-p": None, "-N": "1", "-n": "1", "-t": None, "-d": None, "name": None}
+        it = iter(args)
+        for arg in it:
+            if arg in ("-p", "-N", "-n", "-t", "-d"):
+                paras[arg] = next(it)
+            elif not arg.startswith("-"):
+                paras["name"] = arg
+        dependency = None
+        if paras["-d"] is not None:
+            dependency = [int(i) for i in paras["-d"].split(":")[1:]]
+        return {"partition": paras["-p"], "node": int(paras["-N"]), "core": int(paras["-n"]),
+                "time": paras["-t"], "dependency": dependency, "name": paras["name"]}
+
+    @staticmethod
+    def _elapsed(secs):
+        secs = int(secs)
+        days, secs = divmod(secs, 86400)
+        hours, secs = divmod(secs, 3600)
+        mins, secs = divmod(secs, 60)
+        if days:
+            return f"{days}-{hours:02d}:{mins:02d}:{secs:02d}"
+        if hours:
+            return f"{hours}:{mins:02d}:{secs:02d}"
+        return f"{mins}:{secs:02d}"
+
+
+class LocalJob:
+    def __init__(self, job_id, name, cwd, node, limit, dependency):
+        self.id = job_id
+        self.name = name
+        self.cwd = cwd
+        self.node = node
+        self.limit = limit
+        self.dependency = dependency
+        self.state = "PD"
+        self.proc = None
+        self.start = None
+
+
+class LocalBackend(Backend):
+    FAILED = ("CA", "TO", "F")
+
+    def __init__(self, cores=0, node_cores=0, mpi="mpirun -np", partition="local", poll=1.0):
+        if not cores:
+            # cores nobody else is using right now
+            cores = max(1, (os.cpu_count() or 1) - int(os.getloadavg()[0]))
+        self.cores = cores
+        self.node_cores = min(node_cores or cores, cores)
+        self.nodes = max(1, cores // self.node_cores)
+        self.free = self.nodes
+        self.mpi = mpi
+        self.partition = partition
+        self.poll = poll
+        self.jobs = {}
+        self.pending = []
+        self.next_id = 1
+        self._lock = threading.RLock()
+        self._watcher = None
+        self._write_launcher()
+
+    @classmethod
+    def from_config(cls):
+        return cls(cores=CONDOR.getint("LOCAL", "CORES", fallback=0),
+                   node_cores=CONDOR.getint("LOCAL", "NODE_CORES", fallback=0),
+                   mpi=CONDOR.get("LOCAL", "MPI", fallback="mpirun -np"),
+                   partition=CONDOR.get("ALLOW", "PARTITION", fallback="local") or "local")
+
+    def _write_launcher(self):
+        # the generated scripts call yhrun, run the program on the cores of the job instead
+        TH_LOCAL_BIN.mkdir(exist_ok=True)
+        launcher = TH_LOCAL_BIN / "yhrun"
+        prog = f"{self.mpi} ${{DFTFLOW_NP:-1}} \"$@\"" if self.mpi else "\"$@\""
+        launcher.write_text(
+            "#!/bin/bash\n"
+            "while [[ \"$1\" == -* ]]; do\n"
+            "  case \"$1\" in -N|-n|-p|-w|-t) shift 2;; *) shift;; esac\n"
+            "done\n"
+            f"exec {prog}\n"
+        )
+        launcher.chmod(0o755)
+
+    def _start(self, job: LocalJob):
+        env = os.environ.copy()
+        env["PATH"] = f"{TH_LOCAL_BIN}:{env.get('PATH', '')}"
+        env["SLURM_JOB_ID"] = str(job.id)
+        env["DFTFLOW_NP"] = str(job.node * self.node_cores)
+        with open(os.path.join(job.cwd, f"slurm-{job.id}.out"), "w") as out:
+            job.proc = subprocess.Popen(["bash", job.name], cwd=job.cwd, env=env, stdout=out,
+                                        stderr=subprocess.STDOUT, start_new_session=True)
+        job.start = time.time()
+        job.state = "R"
+        self.free -= job.node
+
+    def _stop(self, job: LocalJob, state):
+        if job.state == "R":
+            if job.proc.poll() is None:
+                os.killpg(job.proc.pid, signal.SIGTERM)
+                job.proc.wait()
+            self.free += job.node
+        job.state = state
+
+    def _reap(self):
+        now = time.time()
+        for job in self.jobs.values():
+            if job.state != "R":
+                continue
+            rc = job.proc.poll()
+            if rc is not None:
+                self.free += job.node
+                job.state = "CD" if rc == 0 else "F"
+            elif job.limit and now - job.start > job.limit:
+                self._stop(job, "TO")
+
+    def _ready(self, job: LocalJob):
+        if job.dependency is None:
+            return True
+        states = [self.jobs[i].state for i in job.dependency if i in self.jobs]
+        if any(state in self.FAILED for state in states):
+            job.state = "CA"
+            return None
+        return all(state == "CD" for state in states)
+
+    def _schedule(self):
+        waiting = []
+        for job in self.pending:
+            ready = self._ready(job)
+            if ready is None:
+                continue
+            if ready and job.node <= self.free:
+                self._start(job)
+            else:
+                waiting.append(job)
+        self.pending = waiting
+
+    def _step(self):
+        with self._lock:
+            self._reap()
+            self._schedule()
+            return any(job.state in ("PD", "R") for job in self.jobs.values())
+
+    def _watch(self):
+        while True:
+            with self._lock:
+                if not self._step():
+                    self._watcher = None
+                    return
+            time.sleep(self.poll)
+
+    def run(self, cmd):
+        with self._lock:
+            self._reap()
+            self._schedule()
+            return super(LocalBackend, self).run(cmd)
+
+    def wait(self):
+        while self._step():
+            time.sleep(self.poll)
+
+    def _yhbatch(self, args, cwd):
+        paras = self._batch_args(args)
+        if paras["name"] is None or not os.path.exists(os.path.join(cwd, paras["name"])):
+            return 1, f"yhbatch: error: Unable to open file {paras['name']}"
+        limit = TianHeTime.from_string(paras["time"]).seconds if paras["time"] else None
+        job = LocalJob(self.next_id, paras["name"], cwd, min(paras["node"], self.nodes), limit,
+                       paras["dependency"])
+        self.next_id += 1
+        self.jobs[job.id] = job
+        self.pending.append(job)
+        self._schedule()
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, daemon=True)
+            self._watcher.start()
+        return 0, f"Submitted batch job {job.id}"
+
+    def _yhqueue(self, args, cwd):
+        now = time.time()
+        lines = []
+        for job in self.jobs.values():
+            if job.state not in ("PD", "R"):
+                continue
+            elapsed = now - job.start if job.state == "R" else 0
+            # a reason, not a host: the cores are on this host and no node of a local job is
+            # cleared over ssh, pkill there would hit the sibling jobs too
+            where = "(Local)" if job.state == "R" else \
+                "(Dependency)" if job.dependency else "(Resources)"
+            lines.append(f"{job.id}|{self.partition}|{job.name}|{os.environ.get('USER', '')}|"
+                         f"{job.state}|{self._elapsed(elapsed)}|{job.node}|{where}")
+        return 0, "\n".join(lines)
+
+    def _yhinfo(self, args, cwd):
+        partition = self.partition
+        if "-p" in args:
+            # an empty PARTITION leaves "-p" right before the next option
+            partition = args[args.index("-p") + 1]
+            partition = "" if partition.startswith("-") else partition
+        return 0, f"{partition}|{self.nodes - self.free}/{self.free}/0/{self.nodes}"
+
+    def _yhcancel(self, args, cwd):
+        for job_id in args:
+            job = self.jobs.get(int(job_id))
+            if job is not None and job.state in ("PD", "R"):
+                self._stop(job, "CA")
+        self.pending = [job for job in self.pending if job.state == "PD"]
+        self._schedule()
+        return 0, ""
+
+
+class LocalJobBackend(Backend):
+    # the scheduler seen from inside a job of LocalBackend. The process that runs the jobs is
+    # out of reach, the queue is the snapshot it recorded and a job can only cancel itself
+    records = False
+
+    def _yhqueue(self, args, cwd):
+        running = RUNNING_JOB_LOG.csv
+        if running is None:
+            return 1, "yhqueue: no snapshot recorded by the submitting process"
+        return 0, "\n".join("|".join(str(i) for i in row)
+                             for row in running[YHQ_COLUMN].values.tolist())
+
+    def _yhinfo(self, args, cwd):
+        hpc = HPC_LOG.csv
+        if hpc is None:
+            return 1, "yhinfo: no snapshot recorded by the submitting process"
+        sys_yhi = hpc.loc[hpc["CLASS"] != "USER"].iloc[0]
+        partition = args[args.index("-p") + 1] if "-p" in args else ""
+        partition = "" if partition.startswith("-") else partition
+        nodes = "/".join(str(int(float(sys_yhi[i]))) for i in ("ALLOC", "IDLE", "DRAIN", "TOTAL"))
+        return 0, f"{partition}|{nodes}"
+
+    def _yhcancel(self, args, cwd):
+        # LocalBackend started the job in a session of its own, its process group is the job
+        if os.environ.get("SLURM_JOB_ID") in args:
+            os.killpg(os.getpgrp(), signal.SIGTERM)
+        return 0, ""
+
+
+def get_backend(name=None):
+    if name is None:
+        name = CONDOR.get("BACKEND", "NAME", fallback="tianhe")
+    if name == "tianhe":
+        return None
+    if name == "local":
+        return LocalBackend.from_config()
+    raise ValueError(f"unknown backend: {name}")
+
+
+def get_job_backend(name=None):
+    # what vasp.py run by a job script talks to, a job of the local backend never calls the
+    # TianHe commands
+    if name is None:
+        name = CONDOR.get("BACKEND", "NAME", fallback="tianhe")
+    if name == "local":
+        return LocalJobBackend()
+    return get_backend(name)
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+
+_HOST_RE = re.compile(r"([^,\[]+)(?:\[([^\]]+)\])?(?:,|$)")
+
+
+def _expand_range(prefix, ranges):
+    hosts = []
+    for item in ranges.split(","):
+        if "-" not in item:
+            hosts.append(f"{prefix}{item}")
+            continue
+        start, end = item.split("-", 1)
+        width = len(start)
+        for i in range(int(start), int(end) + 1):
+            hosts.append(f"{prefix}{i:0{width}d}")
+    return hosts
+
+
+def expand_hostlist(hostlist):
+    # cn[100-103,200],cn305 -> cn100 cn101 cn102 cn103 cn200 cn305, reasons like (Priority) -> []
+    hostlist = hostlist.strip() if isinstance(hostlist, str) else ""
+    if not hostlist or hostlist.startswith("("):
+        return []
+    hosts = []
+    for prefix, ranges in _HOST_RE.findall(hostlist):
+        if not prefix:
+            continue
+        if ranges:
+            hosts.extend(_expand_range(prefix, ranges))
+        else:
+            hosts.append(prefix)
+    return hosts
+
+
+def host_number(host):
+    return int(re.sub(r"^\D+", "", host))
+
+
+def compress_hostlist(hosts, prefix="cn"):
+    numbers = sorted(host if isinstance(host, int) else host_number(host) for host in hosts)
+    if not numbers:
+        return ""
+    ranges = []
+    start = end = numbers[0]
+    for i in numbers[1:]:
+        if i == end + 1:
+            end = i
+            continue
+        ranges.append(f"{start}-{end}" if end > start else f"{start}")
+        start = end = i
+    ranges.append(f"{start}-{end}" if end > start else f"{start}")
+    if len(numbers) == 1:
+        return f"{prefix}{numbers[0]}"
+    return f"{prefix}[{','.join(ranges)}]"
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import json
+import time
+import socket
+
+from utils.spath import SPath
+from utils.store import Changes, JobStore
+from utils.tools import write_tsv, FileLock
+from utils.lazy import lazy_import
+
+pandas = lazy_import("pandas")
+
+
+def normalize_key(val):
+    # "1000", 1000 and 1000.0 are one JOBID, the TSV and yhbatch disagree on its type
+    val = JobStore._value(val)
+    if val is None:
+        return None
+    if isinstance(val, float) and val.is_integer():
+        val = int(val)
+    return str(val)
+
+
+class JournalTable:
+    # rows of a snapshot with the journal events folded in, matched like LogCsv matches them
+    key = staticmethod(normalize_key)
+
+    def __init__(self, columns=(), rows=()):
+        self.columns = list(columns)
+        self.rows = [dict(zip(self.columns, row)) for row in rows]
+        self._indexes = {}
+
+    def _index(self, label):
+        if label not in self._indexes:
+            index = {}
+            for pos, row in enumerate(self.rows):
+                if row is not None:
+                    index.setdefault(self.key(row.get(label)), []).append(pos)
+            self._indexes[label] = index
+        return self._indexes[label]
+
+    def find(self, label, val):
+        key = self.key(val)
+        if key is None:
+            return []
+        return list(self._index(label).get(key, []))
+
+    def _set(self, pos, label, val):
+        row = self.rows[pos]
+        if label in self._indexes:
+            old = self._indexes[label].get(self.key(row.get(label)), [])
+            if pos in old:
+                old.remove(pos)
+            self._indexes[label].setdefault(self.key(val), []).append(pos)
+        row[label] = val
+        if label not in self.columns:
+            self.columns.append(label)
+
+    def fold(self, op):
+        kind, args = op[0], op[1:]
+        if kind == "update":
+            match_lb, match_val, values = args
+            for pos in self.find(match_lb, match_val):
+                for label, val in values.items():
+                    self._set(pos, label, val)
+        elif kind == "insert":
+            row, = args
+            self.rows.append({})
+            for label, val in row.items():
+                self._set(len(self.rows) - 1, label, val)
+        elif kind == "delete":
+            label, val = args
+            for pos in self.find(label, val):
+                row = self.rows[pos]
+                for index_lb, index in self._indexes.items():
+                    positions = index.get(self.key(row.get(index_lb)), [])
+                    if pos in positions:
+                        positions.remove(pos)
+                self.rows[pos] = None
+
+    def frame(self):
+        # indexed by row position, like LogCsv.get keeps the index of the matched rows
+        live = [pos for pos, row in enumerate(self.rows) if row is not None]
+        rows = [[self.rows[pos].get(c) for c in self.columns] for pos in live]
+        return pandas.DataFrame(rows, columns=self.columns, index=live)
+
+
+class JournalLog:
+    # same operations as utils.log.LogCsv. Row changes are appended to a journal, a snapshot
+    # holds the table up to a byte offset of the journal and readers fold the tail on top
+    SNAPSHOT_HEAD = "# journal offset "
+
+    def __init__(self, journal: SPath, csv: SPath = None, compact=1 << 20):
+        self._journal = journal
+        self._snapshot = journal.with_suffix(".snapshot")
+        self._tsv = csv if csv is not None else journal.with_suffix(".csv")
+        self._lock = FileLock(journal.with_suffix(".lock"))
+        # bytes of journal tail that trigger a compaction, 0 compacts only on request
+        self.compact_size = compact
+        self._pending = Changes()
+        self._table = None
+        self._stat = None
+        self._offset = 0
+        self._csv = None
+        self._csv_key = None
+
+    def __repr__(self):
+        return str(self._journal)
+
+    def __str__(self):
+        return repr(self.csv)
+
+    @property
+    def path(self):
+        # the table, the journal only exists after the first change
+        return self._snapshot
+
+    @staticmethod
+    def _line(op):
+        kind, args = op[0], op[1:]
+        event = {"time": round(time.time(), 3), "host": socket.gethostname(),
+                 "pid": os.getpid(), "op": kind}
+        if kind == "update":
+            event["match"] = [args[0], JobStore._value(args[1])]
+            event["values"] = {k: JobStore._value(v) for k, v in args[2].items()}
+        elif kind == "insert":
+            event["values"] = {k: JobStore._value(v) for k, v in args[0].items()}
+        elif kind == "delete":
+            event["match"] = [args[0], JobStore._value(args[1])]
+        return json.dumps(event) + "\n"
+
+    @staticmethod
+    def _op(event):
+        if event["op"] == "update":
+            return "update", event["match"][0], event["match"][1], event["values"]
+        if event["op"] == "insert":
+            return "insert", event["values"]
+        return "delete", event["match"][0], event["match"][1]
+
+    def _append(self, lines):
+        # one write with O_APPEND, concurrent writers of a local or Lustre file never interleave
+        # within it. NFS does not honour O_APPEND across clients
+        fd = os.open(self._journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, "".join(lines).encode())
+        finally:
+            os.close(fd)
+
+    def _events(self, offset):
+        # complete lines after offset, a line still being written is left for the next read
+        try:
+            with open(self._journal, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return [], offset
+        end = data.rfind(b"\n") + 1
+        lines = data[:end].decode().splitlines()
+        return [json.loads(line) for line in lines if line], offset + end
+
+    def _read_snapshot(self):
+        if self._snapshot.exists():
+            with open(self._snapshot) as f:
+                offset = int(f.readline()[len(self.SNAPSHOT_HEAD):])
+                df = pandas.read_csv(f, sep="\t")
+        elif self._tsv.exists():
+            # first use after switching from the TSV log
+            offset, df = 0, pandas.read_csv(self._tsv, sep="\t")
+        else:
+            return 0, None
+        return offset, df
+
+    def _stat_key(self):
+        try:
+            st = os.stat(self._snapshot)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def _state(self):
+        stat = self._stat_key()
+        if self._table is None or stat != self._stat:
+            offset, df = self._read_snapshot()
+            self._table = None if df is None else \
+                JournalTable(df.columns, df.itertuples(index=False, name=None))
+            self._stat, self._offset = stat, offset
+        events, self._offset = self._events(self._offset)
+        if events and self._table is None:
+            self._table = JournalTable()
+        for event in events:
+            self._table.fold(self._op(event))
+        return self._table
+
+    def _write_snapshot(self, offset, head: list, rows):
+        tmp = self._snapshot.with_name(
+            f".{self._snapshot.name}.{socket.gethostname()}.{os.getpid()}")
+        with open(tmp, "w") as f:
+            f.write(f"{self.SNAPSHOT_HEAD}{offset}\n")
+            write_tsv(f, head, rows)
+        os.replace(tmp, self._snapshot)
+
+    def _journal_size(self):
+        try:
+            return os.stat(self._journal).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _snapshot_offset(self):
+        try:
+            with open(self._snapshot) as f:
+                return int(f.readline()[len(self.SNAPSHOT_HEAD):])
+        except FileNotFoundError:
+            return 0
+
+    def compact(self, wait=True):
+        # fold the tail into a new snapshot, the journal itself is kept as the history and
+        # appends after the folded offset stay in the tail. The lock keeps a whole table
+        # written meanwhile from being replaced by the older folded one
+        if not self._lock.acquire(block=wait):
+            return False
+        try:
+            table = self._state()
+            if table is not None:
+                self._write_snapshot(self._offset, table.columns,
+                                     ([row.get(c) for c in table.columns]
+                                      for row in table.rows if row is not None))
+                self._stat = self._stat_key()
+        finally:
+            self._lock.release()
+        return True
+
+    def _stage(self, *ops):
+        changes = Changes(ops)
+        self._pending.extend(changes)
+        return changes
+
+    def apply_(self, changes):
+        if not isinstance(changes, Changes):
+            # a whole table, e.g. the yhqueue snapshot, starts a new snapshot at the journal end
+            with self._lock:
+                self._write_snapshot(self._journal_size(), list(changes.columns),
+                                     changes.itertuples(index=False, name=None))
+            self._table = None
+        else:
+            self._append([self._line(op) for op in changes])
+            done = set(map(id, changes))
+            self._pending = Changes(op for op in self._pending if id(op) not in done)
+        if self.compact_size and \
+                self._journal_size() - self._snapshot_offset() > self.compact_size:
+            self.compact(wait=False)
+
+    def apply(self):
+        self.apply_(self._pending)
+
+    @property
+    def csv(self):
+        table = self._state()
+        if table is None:
+            return None
+        # built again only when the snapshot or the folded offset moved, as LogCsv re-reads
+        # only a changed file
+        key = (self._stat, self._offset)
+        if key != self._csv_key:
+            # through the TSV text, the columns get the types LogCsv reads
+            frame = table.frame()
+            buf = io.StringIO()
+            frame.to_csv(buf, sep="\t", na_rep="?", index=False)
+            buf.seek(0)
+            self._csv = pandas.read_csv(buf, sep="\t")
+            self._csv.index = frame.index
+            self._csv_key = key
+        return self._csv
+
+    def add(self, new_data):
+        if isinstance(new_data, dict):
+            return self._stage(("insert", new_data))
+        return self._stage(*(("insert", row) for row in new_data.to_dict("records")))
+
+    def alter(self, lb, old_val, new_val):
+        return self._stage(("update", lb, old_val, {lb: new_val}))
+
+    def alter_(self, match_lb, match_val, alter_lb, alter_val):
+        return self._stage(("update", match_lb, match_val, {alter_lb: alter_val}))
+
+    def alter_many(self, match_lb, match_val, values):
+        return self._stage(("update", match_lb, match_val, dict(values)))
+
+    def alter_batch(self, match_lb, items):
+        return self._stage(*(("update", match_lb, match_val, dict(values))
+                             for match_val, values in items))
+
+    def drop_one(self, label, value, **kwargs):
+        return self._stage(("delete", label, value))
+
+    def contain(self, label, val):
+        table = self._state()
+        return table is not None and bool(table.find(label, val))
+
+    def get(self, label, val):
+        csv = self.csv
+        if csv is None:
+            return None
+        return csv.loc[self._table.find(label, val)]
+
+    def touch(self, head: list, values):
+        with self._lock:
+            self._write_snapshot(self._journal_size(), head, values)
+        self._table = None
+
+    def history(self, label, val):
+        # every event of one row, a changed match value (a promoted WORKDIR) is followed
+        keys, events = {normalize_key(val)}, []
+        for event in self._events(0)[0]:
+            values = event.get("values", {})
+            match = event.get("match")
+            if (match and match[0] == label and normalize_key(match[1]) in keys) or \
+                    (match is None and normalize_key(values.get(label)) in keys):
+                events.append(event)
+                if label in values:
+                    keys.add(normalize_key(values[label]))
+        return events
+
+    def export(self, path: SPath = None):
+        csv = self.csv
+        if csv is None:
+            return None
+        path = self._tsv if path is None else path
+        tmp = path.with_name(f".{path.name}.{os.getpid()}")
+        csv.to_csv(tmp, sep="\t", na_rep="?", index=False)
+        os.replace(tmp, path)
+        return path
+
+
+if __name__ == '__main__':
+    pass
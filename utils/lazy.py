@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+import importlib
+from functools import partial
+
+
+class LazyObject:
+    # stands in for a value that is expensive to build, e.g. a parsed config file
+    def __init__(self, factory):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_value", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _load(self):
+        value = object.__getattribute__(self, "_value")
+        if value is None:
+            with object.__getattribute__(self, "_lock"):
+                value = object.__getattribute__(self, "_value")
+                if value is None:
+                    value = object.__getattribute__(self, "_factory")()
+                    object.__setattr__(self, "_value", value)
+        return value
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __setattr__(self, key, value):
+        setattr(self._load(), key, value)
+
+    def __getitem__(self, item):
+        return self._load()[item]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+
+    def __delitem__(self, key):
+        del self._load()[key]
+
+    def __contains__(self, item):
+        return item in self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __bool__(self):
+        return bool(self._load())
+
+    def __eq__(self, other):
+        return self._load() == other
+
+    def __repr__(self):
+        return repr(self._load())
+
+
+def lazy_import(name):
+    # the module is imported on its first attribute access, not at import time.
+    # importlib.util.LazyLoader is not thread safe before python 3.12, the submitters
+    # touch pandas from several threads
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyObject(partial(importlib.import_module, name))
+
+
+if __name__ == '__main__':
+    pass
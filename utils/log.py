@@ -1,24 +1,56 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-import pandas
+import os
+import socket
 import logging
 
-from utils.tools import dataframe_from_dict
+from utils.tools import write_tsv
 from utils.spath import SPath
+from utils.store import JobStore
+from utils.journal import JournalLog, normalize_key
+from utils.lazy import lazy_import
+
+pandas = lazy_import("pandas")
+# config imports utils, its condor.ini is read on the first open_log
+config = lazy_import("config")
 
 
 class LogCsv:
     def __init__(self, csv: SPath):
         self._path = csv
-        self._read()
+        # read on access, importing utils must not load pandas
+        self._csv = None
+        # parsed file and its row positions per column, valid while the stat key is unchanged
+        self._cached = None
+        self._stat = None
+        self._indexes = {}
 
     def __repr__(self):
         return str(self._path)
 
     def _read(self):
-        self._csv = None
-        if self._path.exists():
-            self._csv = pandas.read_csv(self._path, sep="\t")
+        try:
+            st = os.stat(self._path)
+        except FileNotFoundError:
+            self._cached, self._stat, self._indexes = None, None, {}
+            self._csv = None
+            return
+        # apply_ renames a new file over the old one, the inode changes even within one mtime tick
+        stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+        if stat != self._stat:
+            self._cached = pandas.read_csv(self._path, sep="\t")
+            self._stat, self._indexes = stat, {}
+        self._csv = self._cached
+
+    def _index(self, label):
+        # value -> row positions, NaN is left out like it never matches ==. No file, no rows
+        self._read()
+        if self._cached is None:
+            return {}
+        if label not in self._indexes:
+            column = self._cached[label]
+            self._indexes[label] = column.groupby(column, sort=False).indices
+        return self._indexes[label]
 
     @property
     def csv(self):
@@ -36,8 +68,14 @@ class LogCsv:
     def __str__(self):
         return repr(self.csv)
 
-    def apply_(self, df: pandas.DataFrame):
-        return df.to_csv(self._path, sep="\t", na_rep="?", index=False)
+    def _tmp(self):
+        return self._path.with_name(f".{self._path.name}.{socket.gethostname()}.{os.getpid()}")
+
+    def apply_(self, df: "pandas.DataFrame"):
+        # write aside and rename, readers on other nodes never see a half written table
+        tmp = self._tmp()
+        df.to_csv(tmp, sep="\t", na_rep="?", index=False)
+        os.replace(tmp, self._path)
 
     def apply(self):
         self.apply_(self.csv)
@@ -60,14 +98,18 @@ class LogCsv:
         self.csv = tmp
         return tmp
 
+    @staticmethod
+    def _key(val):
+        return os.fspath(val) if isinstance(val, os.PathLike) else val
+
     @staticmethod
     def _alter(df, mk, mv, nv):
-        df.loc[df[mk] == mv, mk] = nv
+        df.loc[df[mk] == LogCsv._key(mv), mk] = nv
         return df
 
     @staticmethod
     def __alter(df, mk, mv, ak, av):
-        df.loc[df[mk] == mv, ak] = av
+        df.loc[df[mk] == LogCsv._key(mv), ak] = av
         return df
 
     def alter_many(self, match_lb, match_val, values):
@@ -77,32 +119,72 @@ class LogCsv:
         self.csv = tmp
         return tmp
 
+    def alter_batch(self, match_lb, items):
+        tmp = self.csv.copy()
+        for match_val, values in items:
+            for k, v in values.items():
+                tmp = self.__alter(tmp, match_lb, match_val, k, v)
+        self.csv = tmp
+        return tmp
+
     def drop_one(self, label, value, **kwargs):
         tmp = self.csv.copy()
-        row_list = tmp.loc[tmp[label] == value].index.tolist()
+        row_list = tmp.loc[tmp[label] == self._key(value)].index.tolist()
         tmp = tmp.drop(row_list, inplace=True, **kwargs)
         self.csv = tmp
         return tmp
 
+    @staticmethod
+    def _keys(val):
+        # "1000", 1000 and 1000.0 are one JOBID, read_csv types a column by all of its values
+        val = LogCsv._key(val)
+        key = normalize_key(val)
+        keys = [val, key]
+        if key is not None and key.isdigit():
+            keys.extend([int(key), float(key)])
+        return keys
+
+    def _rows(self, label, val):
+        index = self._index(label)
+        for key in self._keys(val):
+            if key in index:
+                return index[key]
+        return []
+
     def contain(self, label, val):
-        tmp = self.csv.copy()
-        return bool(tmp.loc[tmp[label] == val].index.tolist())
+        return len(self._rows(label, val)) > 0
 
     def get(self, label, val):
-        tmp = self.csv.copy()
-        return tmp.loc[tmp[label] == val]
-
-    def touch(self, head: list, values: list):
-        nov = len(values)
-        tmp = dataframe_from_dict(
-            dict(zip(head, values[0]))
-        )
-        for idx in range(1, nov):
-            tmp = tmp.append(
-                dataframe_from_dict(
-                    dict(zip(head, values[idx]))), ignore_index=True
-            )
-        self.apply_(tmp)
+        rows = self._rows(label, val)
+        if self._cached is None:
+            return None
+        return self._cached.iloc[rows]
+
+    def export(self, path: SPath = None):
+        if path is None or path == self._path:
+            return self._path
+        self._path.copy_to(path)
+        return path
+
+    def touch(self, head: list, values):
+        # values may be a generator, the rows are written as they come
+        tmp = self._tmp()
+        with open(tmp, "w") as f:
+            write_tsv(f, head, values)
+        os.replace(tmp, self._path)
+
+
+def open_log(csv: SPath):
+    # [LOG] BACKEND of condor.ini, csv, sqlite or journal
+    condor = config.CONDOR
+    backend = condor.get("LOG", "BACKEND", fallback="csv")
+    if backend == "sqlite":
+        return JobStore(csv.with_suffix(".db"), csv,
+                        journal=condor.get("LOG", "JOURNAL", fallback="WAL"))
+    if backend == "journal":
+        return JournalLog(csv.with_suffix(".journal"), csv,
+                          compact=condor.getint("LOG", "COMPACT", fallback=1 << 20))
+    return LogCsv(csv)
 
 
 class Notice:
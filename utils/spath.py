@@ -5,10 +5,12 @@ import configparser
 import pathlib
 import shutil
 import os
-import yaml
 import json
 
-from monty.io import reverse_readfile
+from utils.lazy import lazy_import
+
+yaml = lazy_import("yaml")
+monty_io = lazy_import("monty.io")
 
 
 class SPath(type(pathlib.Path())):
@@ -70,7 +72,7 @@ class SPath(type(pathlib.Path())):
                 yield line.strip('\n')
 
     def readline_text_reversed(self):
-        yield from reverse_readfile(str(self))
+        yield from monty_io.reverse_readfile(str(self))
 
     def add_to_text(self, data, encoding='utf-8', errors='ignore'):
         if not isinstance(data, str):
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import math
+import sqlite3
+from contextlib import contextmanager
+
+from utils.spath import SPath
+from utils.lazy import lazy_import
+
+pandas = lazy_import("pandas")
+
+
+class Changes(list):
+    # row operations of a JobStore, written by JobStore.apply_ in one transaction
+    pass
+
+
+class JobStore:
+    # same operations as utils.log.LogCsv on a SQLite table, every change touches only its rows
+    TABLE = "log"
+    INDEXED = ("JOBID", "WORKDIR")
+
+    def __init__(self, db: SPath, csv: SPath = None, journal="WAL"):
+        self._path = db
+        self._tsv = csv if csv is not None else db.with_suffix(".csv")
+        self.journal = journal
+        self._pending = Changes()
+
+    def __repr__(self):
+        return str(self._path)
+
+    def __str__(self):
+        return repr(self.csv)
+
+    @property
+    def path(self):
+        return self._path
+
+    @contextmanager
+    def _connect(self):
+        fresh = not self._path.exists()
+        # autocommit, every write opens its own BEGIN IMMEDIATE transaction
+        con = sqlite3.connect(str(self._path), timeout=60, isolation_level=None)
+        try:
+            con.execute(f"PRAGMA journal_mode={self.journal}")
+            con.execute("PRAGMA synchronous=NORMAL")
+            if fresh and self._tsv.exists():
+                # first use after switching from the TSV log
+                df = pandas.read_csv(self._tsv, sep="\t")
+                self._replace(con, list(df.columns), df.itertuples(index=False, name=None))
+            yield con
+        finally:
+            con.close()
+
+    @contextmanager
+    def _transaction(self, con):
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            yield con
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
+
+    @staticmethod
+    def _quote(name):
+        return '"' + str(name).replace('"', '""') + '"'
+
+    @staticmethod
+    def _value(val):
+        if isinstance(val, os.PathLike):
+            return os.fspath(val)
+        if hasattr(val, "item"):
+            # numpy scalars of DataFrame rows
+            val = val.item()
+        if (isinstance(val, float) and math.isnan(val)) or val == "":
+            # empty like read_csv reads an empty field
+            return None
+        return val
+
+    @staticmethod
+    def _frame(con, query, params=()):
+        # through the TSV text, the columns get the types LogCsv reads. A NULL in an integer
+        # column would otherwise turn every JOBID into a float
+        cursor = con.execute(query, params)
+        frame = pandas.DataFrame(cursor.fetchall(), columns=[c[0] for c in cursor.description],
+                                 dtype=object)
+        buf = io.StringIO()
+        frame.to_csv(buf, sep="\t", na_rep="?", index=False)
+        buf.seek(0)
+        return pandas.read_csv(buf, sep="\t")
+
+    def _columns(self, con):
+        return [row[1] for row in con.execute(f"PRAGMA table_info({self.TABLE})")]
+
+    def _create(self, con, columns):
+        # NUMERIC affinity stores "1000" as 1000, like read_csv infers the TSV columns
+        cols = ", ".join(f"{self._quote(c)} NUMERIC" for c in columns)
+        con.execute(f"CREATE TABLE {self.TABLE} ({cols})")
+        self._index(con, columns)
+
+    def _index(self, con, columns):
+        for col in self.INDEXED:
+            if col in columns:
+                con.execute(f"CREATE INDEX IF NOT EXISTS idx_{col.lower()} "
+                            f"ON {self.TABLE} ({self._quote(col)})")
+
+    def _ensure(self, con, have: set, columns):
+        if not have:
+            self._create(con, columns)
+            have.update(columns)
+            return
+        missing = [c for c in columns if c not in have]
+        for col in missing:
+            con.execute(f"ALTER TABLE {self.TABLE} ADD COLUMN {self._quote(col)} NUMERIC")
+        if missing:
+            self._index(con, missing)
+            have.update(missing)
+
+    def _insert(self, con, columns, rows):
+        cols = ", ".join(self._quote(c) for c in columns)
+        marks = ", ".join("?" * len(columns))
+        con.executemany(f"INSERT INTO {self.TABLE} ({cols}) VALUES ({marks})",
+                        ([self._value(v) for v in row] for row in rows))
+
+    def _replace(self, con, columns, rows):
+        with self._transaction(con):
+            con.execute(f"DROP TABLE IF EXISTS {self.TABLE}")
+            self._create(con, columns)
+            self._insert(con, columns, rows)
+
+    def _execute(self, con, have: set, op):
+        kind, args = op[0], op[1:]
+        if kind == "update":
+            match_lb, match_val, values = args
+            self._ensure(con, have, [match_lb] + list(values))
+            sets = ", ".join(f"{self._quote(k)} = ?" for k in values)
+            con.execute(f"UPDATE {self.TABLE} SET {sets} WHERE {self._quote(match_lb)} = ?",
+                        [self._value(v) for v in values.values()] + [self._value(match_val)])
+        elif kind == "insert":
+            row, = args
+            self._ensure(con, have, list(row))
+            self._insert(con, list(row), [list(row.values())])
+        elif kind == "delete":
+            label, value = args
+            if label in have:
+                con.execute(f"DELETE FROM {self.TABLE} WHERE {self._quote(label)} = ?",
+                            [self._value(value)])
+
+    def _stage(self, *ops):
+        changes = Changes(ops)
+        self._pending.extend(changes)
+        return changes
+
+    def apply_(self, changes):
+        with self._connect() as con:
+            if not isinstance(changes, Changes):
+                # a whole table, e.g. the yhqueue snapshot
+                self._replace(con, list(changes.columns),
+                              changes.itertuples(index=False, name=None))
+                return
+            with self._transaction(con):
+                have = set(self._columns(con))
+                for op in changes:
+                    self._execute(con, have, op)
+        done = set(map(id, changes))
+        self._pending = Changes(op for op in self._pending if id(op) not in done)
+
+    def apply(self):
+        self.apply_(self._pending)
+
+    @property
+    def csv(self):
+        if not self._path.exists() and not self._tsv.exists():
+            return None
+        with self._connect() as con:
+            if not self._columns(con):
+                return None
+            return self._frame(con, f"SELECT * FROM {self.TABLE} ORDER BY rowid")
+
+    def add(self, new_data):
+        if isinstance(new_data, dict):
+            return self._stage(("insert", new_data))
+        return self._stage(*(("insert", row) for row in new_data.to_dict("records")))
+
+    def alter(self, lb, old_val, new_val):
+        return self._stage(("update", lb, old_val, {lb: new_val}))
+
+    def alter_(self, match_lb, match_val, alter_lb, alter_val):
+        return self._stage(("update", match_lb, match_val, {alter_lb: alter_val}))
+
+    def alter_many(self, match_lb, match_val, values):
+        return self._stage(("update", match_lb, match_val, dict(values)))
+
+    def alter_batch(self, match_lb, items):
+        return self._stage(*(("update", match_lb, match_val, dict(values))
+                             for match_val, values in items))
+
+    def drop_one(self, label, value, **kwargs):
+        return self._stage(("delete", label, value))
+
+    def _select(self, label, val, what="*", limit=""):
+        if not self._path.exists() and not self._tsv.exists():
+            return None
+        with self._connect() as con:
+            if label not in self._columns(con):
+                return None
+            return self._frame(con, f"SELECT {what} FROM {self.TABLE} "
+                                    f"WHERE {self._quote(label)} = ? ORDER BY rowid {limit}",
+                               [self._value(val)])
+
+    def contain(self, label, val):
+        rows = self._select(label, val, what="1", limit="LIMIT 1")
+        return rows is not None and not rows.empty
+
+    def get(self, label, val):
+        return self._select(label, val)
+
+    def touch(self, head: list, values):
+        # values may be a generator, executemany inserts the rows as they come
+        with self._connect() as con:
+            self._replace(con, head, values)
+
+    def export(self, path: SPath = None):
+        # back to the tab separated file LogCsv reads
+        from_db = self.csv
+        if from_db is None:
+            return None
+        path = self._tsv if path is None else path
+        tmp = path.with_name(f".{path.name}.{os.getpid()}")
+        from_db.to_csv(tmp, sep="\t", na_rep="?", index=False)
+        os.replace(tmp, path)
+        return path
+
+
+if __name__ == '__main__':
+    pass
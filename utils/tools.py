@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from subprocess import getstatusoutput
+import os
+import time
+import socket
+from subprocess import getstatusoutput, PIPE, STDOUT
 from time import sleep
-import pandas
+from itertools import islice
 from multiprocessing.pool import Pool
 
+from utils.lazy import lazy_import
+
+asyncio = lazy_import("asyncio")
+pandas = lazy_import("pandas")
+
 
 def retry(max_retry=None, inter_time=None):
     if max_retry is None:
@@ -32,6 +40,31 @@ def retry(max_retry=None, inter_time=None):
     return decorator
 
 
+def async_retry(max_retry=None, inter_time=None):
+    if max_retry is None:
+        max_retry = 3
+    if inter_time is None:
+        inter_time = 2
+
+    def decorator(func):
+        async def inner(*args, **kwargs):
+            exit_code, results = await func(*args, **kwargs)
+            number = 0
+            if exit_code != 0:
+                while number < max_retry:
+                    await asyncio.sleep(inter_time)
+                    number += 1
+                    print(f'{number} times')
+                    exit_code, results = await func(*args, **kwargs)
+                    if exit_code == 0:
+                        break
+            return exit_code, results
+
+        return inner
+
+    return decorator
+
+
 def dataframe_from_dict(data: dict):
     tmp = {}
     for k, v in data.items():
@@ -41,10 +74,79 @@ def dataframe_from_dict(data: dict):
     return new_data
 
 
+def chunked(iterable, size):
+    it = iter(iterable)
+    block = list(islice(it, size))
+    while block:
+        yield block
+        block = list(islice(it, size))
+
+
+def write_tsv(f, head: list, rows, chunk=10000):
+    # a block of rows at a time, a generator of a million rows never sits in one DataFrame
+    header = True
+    for block in chunked(rows, chunk):
+        pandas.DataFrame(block, columns=head).to_csv(f, sep="\t", na_rep="?", index=False,
+                                                     header=header)
+        header = False
+    if header:
+        pandas.DataFrame([], columns=head).to_csv(f, sep="\t", index=False)
+
+
+class FileLock:
+    # O_EXCL works across Lustre clients, flock is often node local there. A lock older than
+    # stale seconds was left by a dead process
+    def __init__(self, path, stale=120, wait=0.5):
+        self.path = path
+        self.stale = stale
+        self.wait = wait
+
+    def acquire(self, block=True):
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    if time.time() - os.stat(self.path).st_mtime > self.stale:
+                        os.unlink(self.path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if not block:
+                    return False
+                sleep(self.wait)
+                continue
+            os.write(fd, f"{socket.gethostname()} {os.getpid()}\n".encode())
+            os.close(fd)
+            return True
+
+    def release(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
 def get_output(unix_cmd):
     return getstatusoutput(unix_cmd)
 
 
+async def get_output_async(unix_cmd):
+    proc = await asyncio.create_subprocess_shell(unix_cmd, stdout=PIPE, stderr=STDOUT)
+    data, _ = await proc.communicate()
+    data = data.decode(errors="ignore")
+    if data[-1:] == '\n':
+        data = data[:-1]
+    return proc.returncode, data
+
+
 def smart_fmt(inputs):
     if isinstance(inputs, str):
         if inputs.isalpha():
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+
+from utils.spath import SPath
+
+
+class WorkQueue:
+    def __init__(self, root: SPath):
+        self.root = root
+        self._tasks_file = root / "tasks"
+        self._hint = root / "hint"
+        self._claims = root / "claims"
+        self._done = root / "done"
+        self._tasks = None
+
+    def build(self, items):
+        if self.root.exists():
+            self.root.force_rmdir()
+        self.root.mkdir(parents=True)
+        self._claims.mkdir()
+        self._done.mkdir()
+        self._tasks_file.write_text(
+            "".join("\t".join(str(i) for i in item) + "\n" for item in items)
+        )
+        self._hint.write_text("0")
+        self._tasks = None
+        return len(self)
+
+    @property
+    def tasks(self):
+        if self._tasks is None:
+            self._tasks = [line.split("\t") for line in self._tasks_file.readline_text() if line]
+        return self._tasks
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def _read_hint(self):
+        try:
+            return int(self._hint.read_text())
+        except (ValueError, FileNotFoundError):
+            return 0
+
+    def _write_hint(self, idx):
+        tmp = self.root / f"hint.{socket.gethostname()}.{os.getpid()}"
+        tmp.write_text(str(idx))
+        os.replace(tmp, self._hint)
+
+    def pull(self, owner):
+        # the hint is only a starting point, O_EXCL on the claim file decides the owner
+        idx = self._read_hint()
+        while idx < len(self):
+            try:
+                fd = os.open(self._claims / str(idx), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                idx += 1
+                continue
+            os.write(fd, f"{owner}\n".encode())
+            os.close(fd)
+            self._write_hint(idx + 1)
+            return idx, self.tasks[idx]
+        return None
+
+    def done(self, idx, status):
+        (self._done / str(idx)).write_text(f"{status}\n")
+
+    def stats(self):
+        claimed = len(os.listdir(self._claims))
+        done = len(os.listdir(self._done))
+        return {"total": len(self), "pending": len(self) - claimed,
+                "running": claimed - done, "done": done}
+
+
+if __name__ == '__main__':
+    pass
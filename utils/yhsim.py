@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+import heapq
+import random
+import selectors
+from collections import Counter
+from concurrent.futures import Executor, Future
+
+from utils.backend import Backend
+from utils.hostlist import compress_hostlist
+from utils.yhurm import TianHeTime
+from utils.lazy import lazy_import
+
+asyncio = lazy_import("asyncio")
+
+
+class VirtualClock:
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    # nothing to wait for in the simulation, a timeout moves the clock instead of blocking
+    def __init__(self, clock: VirtualClock):
+        super(_VirtualSelector, self).__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        events = super(_VirtualSelector, self).select(0)
+        if events or timeout is None:
+            return events or super(_VirtualSelector, self).select(timeout)
+        self.clock.sleep(timeout)
+        return events
+
+
+class InlineExecutor(Executor):
+    # run_in_executor in the calling thread, a worker thread would finish at a real time the
+    # virtual clock knows nothing of
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as err:
+            future.set_exception(err)
+        return future
+
+
+def run_virtual(main, clock: VirtualClock):
+    # asyncio on the virtual clock, sleeps and timeouts of an hour take no real time
+    loop = asyncio.SelectorEventLoop(_VirtualSelector(clock))
+    loop.time = clock.time
+    try:
+        return loop.run_until_complete(main)
+    finally:
+        loop.close()
+
+
+def runtime_sampler(spec, rng: random.Random):
+    kind, _, args = spec.partition(":")
+    args = [float(i) for i in args.split(",")] if args else []
+    if kind == "fixed":
+        return lambda: args[0]
+    if kind == "uniform":
+        return lambda: rng.uniform(args[0], args[1])
+    if kind == "exp":
+        return lambda: rng.expovariate(1 / args[0])
+    if kind == "lognormal":
+        # median and sigma of log(runtime)
+        return lambda: args[0] * math.exp(rng.gauss(0, args[1]))
+    raise ValueError(f"unknown runtime distribution: {spec}")
+
+
+class SimJob:
+    def __init__(self, job_id, name, node, limit, dependency, runtime, submit):
+        self.id = job_id
+        self.name = name
+        self.node = node
+        self.limit = limit
+        self.dependency = dependency
+        self.runtime = runtime
+        self.submit = submit
+        self.start = None
+        self.end = None
+        self.state = "PD"
+        self.hosts = []
+        self.where = "(Dependency)" if dependency else "(Resources)"
+
+
+class YhSim(Backend):
+    FAILED = ("CA", "TO", "F")
+
+    def __init__(self, nodes=64, partition="work", runtime="lognormal:3600,0.5", seed=0,
+                 clock: VirtualClock = None, latency=0.1, user="sim"):
+        self.nodes = nodes
+        self.partition = partition
+        self.clock = clock if clock is not None else VirtualClock()
+        self.latency = latency
+        self.user = user
+        self.sample = runtime_sampler(runtime, random.Random(seed))
+        self.runtimes = {}
+        self.free = list(range(1, nodes + 1))
+        self.jobs = {}
+        self.active = {}
+        self.pending = []
+        self.running = []
+        self.next_id = 1000
+        self.calls = Counter()
+        self.busy_node_seconds = 0.0
+        self.first_submit = None
+        self.last_end = 0.0
+
+    def run(self, cmd):
+        self.calls[cmd.split("&&")[-1].split()[0]] += 1
+        self.clock.sleep(self.latency)
+        self.advance()
+        return super(YhSim, self).run(cmd)
+
+    def _start(self, job: SimJob, now):
+        job.hosts = [heapq.heappop(self.free) for _ in range(job.node)]
+        job.start = now
+        job.end = now + min(job.runtime, job.limit or math.inf)
+        job.state = "R"
+        job.where = compress_hostlist(job.hosts)
+        heapq.heappush(self.running, (job.end, job.id))
+
+    def _finish(self, job: SimJob, now, state):
+        if job.state == "R":
+            self.busy_node_seconds += job.node * (now - job.start)
+            for host in job.hosts:
+                heapq.heappush(self.free, host)
+            self.last_end = max(self.last_end, now)
+        job.end = now
+        job.state = state
+        self.active.pop(job.id, None)
+
+    def _ready(self, job: SimJob):
+        if job.dependency is None:
+            return True
+        states = [self.jobs[i].state for i in job.dependency if i in self.jobs]
+        if any(state in self.FAILED for state in states):
+            # --kill-on-invalid-dep
+            self._finish(job, self.clock.now, "CA")
+            return None
+        return all(state == "CD" for state in states)
+
+    def _schedule(self, now):
+        waiting = []
+        for job in self.pending:
+            ready = self._ready(job)
+            if ready is None:
+                continue
+            if ready and job.node <= len(self.free):
+                self._start(job, now)
+            else:
+                waiting.append(job)
+        self.pending = waiting
+
+    def advance(self, until=None):
+        until = self.clock.now if until is None else until
+        self._schedule(until)
+        while self.running and self.running[0][0] <= until:
+            end, job_id = heapq.heappop(self.running)
+            job = self.jobs[job_id]
+            if job.state != "R" or job.end != end:
+                continue
+            self._finish(job, end, "TO" if job.limit and job.runtime > job.limit else "CD")
+            self._schedule(end)
+
+    def drain(self):
+        while self.running:
+            self.clock.now = max(self.clock.now, self.running[0][0])
+            self.advance()
+        return self.stats()
+
+    def _yhbatch(self, args, cwd):
+        paras = self._batch_args(args)
+        name, node, dependency = paras["name"], paras["node"], paras["dependency"]
+        if node > self.nodes:
+            return 1, "yhbatch: error: Requested node configuration is not available"
+        limit = TianHeTime.from_string(paras["time"]).seconds if paras["time"] else None
+        runtime = self.runtimes.get(name)
+        if runtime is None:
+            runtime = self.sample()
+        job = SimJob(self.next_id, name, node, limit, dependency, runtime, self.clock.now)
+        self.next_id += 1
+        self.jobs[job.id] = job
+        self.active[job.id] = job
+        self.pending.append(job)
+        if self.first_submit is None:
+            self.first_submit = job.submit
+        self._schedule(self.clock.now)
+        return 0, f"Submitted batch job {job.id}"
+
+    def _yhqueue(self, args, cwd):
+        now = self.clock.now
+        lines = [] if "-h" in args else ["JOBID|PARTITION|NAME|USER|ST|TIME|NODES|NODELIST(REASON)"]
+        for job in self.active.values():
+            elapsed = now - job.start if job.state == "R" else 0
+            lines.append(f"{job.id}|{self.partition}|{job.name}|{self.user}|{job.state}|"
+                         f"{self._elapsed(elapsed)}|{job.node}|{job.where}")
+        return 0, "\n".join(lines)
+
+    def _yhinfo(self, args, cwd):
+        idle = len(self.free)
+        return 0, f"{self.partition}|{self.nodes - idle}/{idle}/0/{self.nodes}"
+
+    def _yhcancel(self, args, cwd):
+        for job_id in args:
+            job = self.active.get(int(job_id))
+            if job is not None:
+                self._finish(job, self.clock.now, "CA")
+        self.pending = [job for job in self.pending if job.state == "PD"]
+        self._schedule(self.clock.now)
+        return 0, ""
+
+    def stats(self):
+        started = [job for job in self.jobs.values() if job.start is not None]
+        waits = sorted(job.start - job.submit for job in started)
+        makespan = self.last_end - (self.first_submit or 0)
+        return {
+            "jobs": len(self.jobs),
+            "states": dict(Counter(job.state for job in self.jobs.values())),
+            "makespan": makespan,
+            "busy_node_seconds": self.busy_node_seconds,
+            "utilization": self.busy_node_seconds / (self.nodes * makespan) if makespan else 0,
+            "wait_mean": sum(waits) / len(waits) if waits else 0,
+            "wait_p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0,
+            "calls": dict(self.calls),
+        }
+
+
+if __name__ == '__main__':
+    pass
@@ -1,14 +1,55 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import re
-from monty import os
-import pandas
-import pexpect
+import math
+import time
+import socket
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-from utils.spath import SPath
-from utils.tools import retry, get_output, dataframe_from_dict
-from utils import RUNNING_JOB_LOG, HPC_LOG, TEMP_FILE, YHI_LABEL, YHQ_LABEL
+from utils.hostlist import expand_hostlist
+from utils.lazy import lazy_import
+from utils.tools import retry, async_retry, get_output, get_output_async
+from utils import RUNNING_JOB_LOG, HPC_LOG, YHI_LABEL, YHQ_LABEL, YHQ_COLUMN, YHQ_FORMAT, \
+    YHI_FORMAT, TH_LOCAL
+from config import CONDOR
+
+asyncio = lazy_import("asyncio")
+monty_os = lazy_import("monty.os")
+pandas = lazy_import("pandas")
+pexpect = lazy_import("pexpect")
+
+SNAPSHOT_STAMP = TH_LOCAL / "snapshot.stamp"
+SNAPSHOT_LOCK = TH_LOCAL / "snapshot.lock"
+
+
+class JobRow(namedtuple("JobRow", ["id", "state", "seconds", "nodes", "nodelist"])):
+    @property
+    def hosts(self):
+        return expand_hostlist(self.nodelist)
+
+
+SCHEDULER = None
+
+
+def use_scheduler(scheduler=None):
+    # point every scheduler command at an in-process stand-in, None restores the shell
+    global SCHEDULER
+    SCHEDULER = scheduler
+
+
+def _shell(cmd):
+    if SCHEDULER is not None:
+        return SCHEDULER.run(cmd)
+    return get_output(cmd)
+
+
+async def _ashell(cmd):
+    if SCHEDULER is not None:
+        return await SCHEDULER.arun(cmd)
+    return await get_output_async(cmd)
 
 
 class TianHeTime:
@@ -21,13 +62,13 @@ class TianHeTime:
             mins = float(mins)
         if not isinstance(secs, float):
             secs = float(secs)
-        if secs > 60:
+        if secs >= 60:
             mins += secs // 60
             secs %= 60
-        if mins > 60:
-            hours += mins
+        if mins >= 60:
+            hours += mins // 60
             mins %= 60
-        if hours > 24:
+        if hours >= 24:
             days += hours // 24
             hours %= 24
 
@@ -47,6 +88,32 @@ class TianHeTime:
     def __repr__(self):
         return f"{self.days}-{self.hours}:{self.mins}:{self.secs}"
 
+    @property
+    def seconds(self):
+        return ((self.days * 24 + self.hours) * 60 + self.mins) * 60 + self.secs
+
+    def to_slurm(self):
+        # whole seconds rounded up, a limit never falls short of the prediction
+        mins, secs = divmod(math.ceil(self.seconds), 60)
+        hours, mins = divmod(mins, 60)
+        days, hours = divmod(hours, 24)
+        return f"{days}-{hours:02d}:{mins:02d}:{secs:02d}"
+
+    @staticmethod
+    def parse_seconds(time_string):
+        days, _, rems = time_string.rpartition("-")
+        if not rems[:1].isdigit():
+            return 0
+        secs = 0
+        for t in rems.split(":"):
+            secs = secs * 60 + int(t)
+        return int(days or 0) * 86400 + secs
+
+    @staticmethod
+    def series_seconds(times: "pandas.Series"):
+        parts = times.astype(str).str.extract(r"^(?:(\d+)-)?(?:(\d+):)?(\d+):(\d+)$")
+        return parts.fillna(0).astype(int).dot([86400, 3600, 60, 1])
+
     @classmethod
     def from_string(cls, time_string):
         if '-' in time_string:
@@ -66,7 +133,8 @@ class TianHeTime:
 
 class TianHeJob:
     def __init__(self, job_id=None, job_path=None, job_stat=None,
-                 node=1, core=24, partition="work", name=None):
+                 node=1, core=24, partition="work", name=None, dependency=None, members=None,
+                 time=None):
         self.id = job_id
         self.path = job_path
         self.stat = job_stat
@@ -74,10 +142,13 @@ class TianHeJob:
         self.core = core
         self.partition = partition
         self.name = name
+        self.dependency = dependency
+        self.members = members
+        self.time = time
 
     @retry(max_retry=5, inter_time=5)
     def yhcancel(self):
-        ok, _ = get_output(f"yhcancel {self.id}")
+        ok, _ = _shell(f"yhcancel {self.id}")
         if ok != 0:
             return ok, None
         RUNNING_JOB_LOG.drop_one(label="JOBID", value=self.id)
@@ -111,11 +182,26 @@ class TianHeJob:
                         control.update({"ST": val})
         return 0, control
 
+    def _yhbatch_cmd(self):
+        cmd = f"yhbatch -p {self.partition} -N {self.node} -n {self.core}"
+        if self.time is not None:
+            cmd += f" -t {self.time}"
+        if self.dependency is not None:
+            cmd += f" -d afterok:{self.dependency} --kill-on-invalid-dep=yes"
+        return f"{cmd} {self.name}"
+
     @retry(max_retry=5, inter_time=5)
     def yhbatch(self):
-        with os.cd(self.path):
-            ok, output = get_output(f"yhbatch -p {self.partition} "
-                                    f"-N {self.node} -n {self.core} {self.name}")
+        with monty_os.cd(self.path):
+            ok, output = _shell(self._yhbatch_cmd())
+        if ok != 0:
+            return ok, None
+        return self._yhbatch_parser(output, **{"WORKDIR": self.path,
+                                               "NAME": self.name})
+
+    @async_retry(max_retry=5, inter_time=5)
+    async def ayhbatch(self):
+        ok, output = await _ashell(f"cd {self.path} && {self._yhbatch_cmd()}")
         if ok != 0:
             return ok, None
         return self._yhbatch_parser(output, **{"WORKDIR": self.path,
@@ -127,7 +213,7 @@ class TianHeJob:
 
     @retry(max_retry=5, inter_time=5)
     def yhcontrol_show_job(self):
-        ok, output = get_output(f"yhcontrol show job {self.id}")
+        ok, output = _shell(f"yhcontrol show job {self.id}")
         if ok != 0:
             return ok, None
         _, update_data = self._yhcontrol_parser(output)
@@ -148,7 +234,7 @@ class TianHeJob:
             job = RUNNING_JOB_LOG.get("JOBID", self.id)
             job_cn = job["TIME"]
             return TianHeTime.from_string(job_cn.values.item())
-        TianHeWorker(**kwargs).flush()
+        TianHeWorker(**kwargs).snapshot()
         if not RUNNING_JOB_LOG.contain("JOBID", self.id):
             return None
         return self.get_time()
@@ -170,11 +256,16 @@ class TianHeJob:
 
 class TianHeWorker:
     def __init__(self, partition="work", total_allowed_node=50,
-                 used_node=0, idle_node=None):
+                 used_node=0, idle_node=None, ttl=None, record=True):
         self.partition = partition
         self.alloc = total_allowed_node
         self._used = used_node
         self._idle = idle_node
+        self._jobs = {}
+        self.record = record
+        if ttl is None:
+            ttl = CONDOR.getfloat("SNAPSHOT", "TTL", fallback=30)
+        self.ttl = ttl
 
     @property
     def idle_node(self):
@@ -193,134 +284,257 @@ class TianHeWorker:
         self._used = val
 
     @staticmethod
-    def _yhi_parser(log: SPath):
-        if log.exists():
-            if not log.is_empty():
-                dat = log.read_text().split()
-                for item in dat:
-                    if "/" in item:
-                        try:
-                            node_info = [int(i) for i in item.split("/")]
-                        except:
-                            break
-                        else:
-                            node_info.insert(0, "SLURM")
-                            return 0, dataframe_from_dict(
-                                dict(zip(YHI_LABEL,
-                                         node_info))
-                            )
+    def _yhi_fmt_parser(text, partition):
+        for line in text.splitlines():
+            fields = line.strip().split("|")
+            if len(fields) != 2 or fields[0] != partition:
+                continue
+            node_info = [int(i) for i in fields[1].split("/")]
+            return 0, dict(zip(YHI_LABEL, ["SLURM", *node_info]))
         return 1, None
 
     @staticmethod
-    def _yhq_parser(log: SPath):
-        if log.exists():
-            if not log.is_empty():
-                dat = pandas.read_table(log, sep=r"\s+")
-                dat["WORKDIR"] = None
-                return 0, dat
-        return 1, None
+    def _yhq_fmt_parser(text):
+        # rows of YHQ_COLUMN plus SECONDS, a DataFrame is only built when the csv is written
+        width = len(YHQ_COLUMN)
+        rows = []
+        for line in text.splitlines():
+            fields = line.split("|", width - 1)
+            if len(fields) != width:
+                continue
+            job_id, partition, name, user, st, elapsed, nodes, node_list = fields
+            rows.append([int(job_id) if job_id.isdigit() else job_id, partition, name, user, st,
+                         elapsed, int(nodes), node_list, TianHeTime.parse_seconds(elapsed)])
+        return 0, rows
+
+    @staticmethod
+    def _job_table(user_yhq):
+        return {
+            str(row[0]): JobRow(str(row[0]), row[4], row[8], row[6], row[7]) for row in user_yhq
+        }
 
     @retry(max_retry=5, inter_time=5)
     def yhq(self):
-        ok, x = get_output(f"yhqueue > {TEMP_FILE}")
+        ok, output = _shell(f"yhqueue -h -o \"{YHQ_FORMAT}\"")
         if ok != 0:
             return ok, None
-        ok, yhq_data = self._yhq_parser(TEMP_FILE)
-        TEMP_FILE.rm_file()
-        if ok != 0:
-            return ok, None
-        return 0, yhq_data
+        return self._yhq_fmt_parser(output)
 
     @retry(max_retry=5, inter_time=5)
     def yhi(self):
-        ok, x = get_output(f"yhinfo -s | grep {self.partition} > {TEMP_FILE}")
+        ok, output = _shell(f"yhinfo -h -p {self.partition} -o \"{YHI_FORMAT}\"")
+        if ok != 0:
+            return ok, None
+        return self._yhi_fmt_parser(output, self.partition)
+
+    @async_retry(max_retry=5, inter_time=5)
+    async def ayhq(self):
+        ok, output = await _ashell(f"yhqueue -h -o \"{YHQ_FORMAT}\"")
         if ok != 0:
             return ok, None
-        ok, yhi_data = self._yhi_parser(TEMP_FILE)
-        TEMP_FILE.rm_file()
+        return self._yhq_fmt_parser(output)
+
+    @async_retry(max_retry=5, inter_time=5)
+    async def ayhi(self):
+        ok, output = await _ashell(f"yhinfo -h -p {self.partition} -o \"{YHI_FORMAT}\"")
         if ok != 0:
             return ok, None
+        return self._yhi_fmt_parser(output, self.partition)
+
+    @property
+    def jobs(self):
+        return self._jobs
+
+    def _update(self, sys_yhi, user_yhq):
+        self._jobs = self._job_table(user_yhq)
+        self._used = sum(row[6] for row in user_yhq)
+        self._idle = sys_yhi["IDLE"]
+
+    def _record(self, sys_yhi, user_yhq):
+        user_yhi = dict(zip(YHI_LABEL, ["USER", self.alloc, self._used, None, None]))
+        all_yhi = pandas.DataFrame([sys_yhi, user_yhi], columns=YHI_LABEL)
+        running = pandas.DataFrame(user_yhq, columns=YHQ_COLUMN + ["SECONDS"])
+        running["WORKDIR"] = None
+        RUNNING_JOB_LOG.apply_(running)
+        HPC_LOG.apply_(all_yhi)
 
-        return 0, yhi_data
+    def _records(self):
+        # a scheduler answering from the recorded snapshot has nothing new to write back
+        return self.record and getattr(SCHEDULER, "records", True)
 
     def flush(self):
-        _, sys_yhi = self.yhi()
-        _, user_yhq = self.yhq()
-        self._used = user_yhq["NODES"].sum()
+        yhi_ok, sys_yhi = self.yhi()
+        yhq_ok, user_yhq = self.yhq()
+        if yhi_ok != 0 or yhq_ok != 0:
+            print("[...]yhinfo/yhqueue failed, the last snapshot is kept")
+            return 1
+        self._update(sys_yhi, user_yhq)
+        if self._records():
+            self._record(sys_yhi, user_yhq)
+            SNAPSHOT_STAMP.write_text(f"{time.time()}")
+        return 0
+
+    async def aflush(self, executor=None):
+        (yhi_ok, sys_yhi), (yhq_ok, user_yhq) = await asyncio.gather(self.ayhi(), self.ayhq())
+        if yhi_ok != 0 or yhq_ok != 0:
+            print("[...]yhinfo/yhqueue failed, the last snapshot is kept")
+            return 1
+        self._update(sys_yhi, user_yhq)
+        if self._records():
+            await asyncio.get_running_loop().run_in_executor(executor, self._record,
+                                                             sys_yhi, user_yhq)
+            SNAPSHOT_STAMP.write_text(f"{time.time()}")
+        return 0
+
+    def _fresh(self, ttl):
+        try:
+            return time.time() - SNAPSHOT_STAMP.stat().st_mtime < ttl
+        except FileNotFoundError:
+            return False
+
+    def _load(self):
+        hpc = HPC_LOG.csv
+        if hpc is None:
+            return 1
+        sys_yhi = hpc.loc[hpc["CLASS"] != "USER"]
+        user_yhi = hpc.loc[hpc["CLASS"] == "USER"]
         self._idle = sys_yhi["IDLE"].values[0]
-        user_yhi = dataframe_from_dict(
-            dict(zip(YHI_LABEL,
-                     ["USER", self.alloc, self._used, None, None]))
-        )
-        all_yhi = sys_yhi.append(user_yhi, ignore_index=True)
-        RUNNING_JOB_LOG.apply_(user_yhq)
-        HPC_LOG.apply_(all_yhi)
+        self._used = user_yhi["IDLE"].values[0]
+        running = RUNNING_JOB_LOG.csv
+        if running is not None and "SECONDS" in running:
+            self._jobs = self._job_table(running[YHQ_COLUMN + ["SECONDS"]].values.tolist())
+        return 0
 
-    def yield_time_limit_exceed_jobs(self, time_limit=TianHeTime(3, 0, 0, 0)):
-        self.flush()
-        for job_id in RUNNING_JOB_LOG.csv["JOBID"]:
-            job = TianHeJob(job_id=job_id)
-            if job.exceeds_time(time_limit):
-                yield job
+    @staticmethod
+    def _lock(stale=120):
+        # O_EXCL works across Lustre clients, flock is often node local there
+        try:
+            fd = os.open(SNAPSHOT_LOCK, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - SNAPSHOT_LOCK.stat().st_mtime > stale:
+                    SNAPSHOT_LOCK.unlink()
+            except FileNotFoundError:
+                pass
+            return False
+        os.write(fd, f"{socket.gethostname()} {os.getpid()}\n".encode())
+        os.close(fd)
+        return True
+
+    @staticmethod
+    def _unlock():
+        try:
+            SNAPSHOT_LOCK.unlink()
+        except FileNotFoundError:
+            pass
+
+    def snapshot(self, ttl=None, wait=0.5):
+        if not self.record:
+            return self.flush()
+        ttl = self.ttl if ttl is None else ttl
+        while not self._fresh(ttl):
+            if self._lock():
+                try:
+                    if not self._fresh(ttl):
+                        return self.flush()
+                finally:
+                    self._unlock()
+                break
+            time.sleep(wait)
+        return self._load()
+
+    async def asnapshot(self, ttl=None, executor=None, wait=0.5):
+        if not self.record:
+            return await self.aflush(executor)
+        ttl = self.ttl if ttl is None else ttl
+        while not self._fresh(ttl):
+            if self._lock():
+                try:
+                    if not self._fresh(ttl):
+                        return await self.aflush(executor)
+                finally:
+                    self._unlock()
+                break
+            await asyncio.sleep(wait)
+        return self._load()
+
+    @staticmethod
+    @retry(max_retry=5, inter_time=5)
+    def yhcancel(job_ids):
+        job_ids = [str(i) for i in job_ids]
+        if not job_ids:
+            return 0, []
+        ok, _ = _shell(f"yhcancel {' '.join(job_ids)}")
+        if ok != 0:
+            return ok, None
+        running = RUNNING_JOB_LOG.csv
+        if running is not None:
+            RUNNING_JOB_LOG.apply_(running.loc[~running["JOBID"].astype(str).isin(job_ids)])
+        return 0, job_ids
+
+    def time_limit_exceed_jobs(self, time_limit=TianHeTime(3, 0, 0, 0), limits=None):
+        self.snapshot()
+        running = RUNNING_JOB_LOG.csv
+        if running is None or running.empty:
+            return []
+        if "SECONDS" in running:
+            seconds = running["SECONDS"]
+        else:
+            seconds = TianHeTime.series_seconds(running["TIME"])
+        job_ids = running["JOBID"].astype(str)
+        bound = job_ids.map(limits or {}).fillna(time_limit.seconds)
+        return job_ids[seconds.values > bound.values].tolist()
+
+    def yield_time_limit_exceed_jobs(self, time_limit=TianHeTime(3, 0, 0, 0), limits=None):
+        for job_id in self.time_limit_exceed_jobs(time_limit, limits):
+            yield TianHeJob(job_id=job_id)
 
 
 class TianHeNodes:
     def __init__(self, job_id):
         self.job_id = job_id
 
-    @staticmethod
-    def _string_parser(cn_string):
-        if "[" not in cn_string:
-            return [int(cn_string.strip("cn"))]
-        tmp = cn_string.strip("[").strip("]")
-        _tmp = tmp.split(',')
-        used_nodes = []
-        for i in _tmp:
-            j = i.replace("cn[", "").replace("]", "")
-            if '-' in j:
-                s, e = j.split('-')
-                used_nodes.extend(
-                    [k for k in range(int(s), int(e) + 1)]
-                )
-            else:
-                used_nodes.append(j)
-        return used_nodes
-
     def get_nodes(self, **kwargs):
-        if RUNNING_JOB_LOG.contain("JOBID", self.job_id):
-            job = RUNNING_JOB_LOG.get("JOBID", self.job_id)
-            job_cn = job["NODELIST(REASON)"]
-            return self._string_parser(job_cn.values.item())
-        TianHeWorker(**kwargs).flush()
-        if not RUNNING_JOB_LOG.contain("JOBID", self.job_id):
+        worker = TianHeWorker(**kwargs)
+        worker.snapshot()
+        job = worker.jobs.get(str(self.job_id))
+        if job is None:
             return None
-        return self.get_nodes()
+        return list(job.hosts)
 
     @staticmethod
-    def _kill_zombie_process(node, key_word):
-        child = pexpect.spawn("ssh cn%d" % node)
+    def _kill_zombie_process(node, key_word, timeout=5):
+        # -x matches the process name only, a pattern match would also hit the remote shell
+        cmd = f"pkill -9 -x {os.path.basename(key_word)}; echo __rc=$?__"
+        child = pexpect.spawn("ssh", [node, cmd], timeout=timeout)
         try:
-            q = child.expect(["yes/no", ""], timeout=5)
+            q = child.expect(["yes/no", r"__rc=(\d+)__"])
             if q == 0:
                 child.sendline("yes")
+                child.expect(r"__rc=(\d+)__")
+            rc = int(child.match.group(1))
         except (pexpect.EOF, pexpect.TIMEOUT):
+            return node, "unreachable"
+        finally:
             child.close()
-            return False
-        else:
-            child.send(
-                "for i in `ps aux | grep %s |awk \'{print $2}\'`;do kill -9 $i;done" % key_word
-            )
-            child.close()
-        return True
-
-    def kill_zombie_process_on_nodes(self, key_word="vasp_std"):
-        results = []
-        for node in self.get_nodes():
-            results.append(
-                self._kill_zombie_process(node, key_word)
-            )
-
-        return all(results)
+        # pkill: 0 killed, 1 nothing matched, 2 and up it could not do its work
+        if rc == 0:
+            return node, "killed"
+        if rc == 1:
+            return node, "clean"
+        return node, f"failed (pkill rc={rc})"
+
+    def kill_zombie_process_on_nodes(self, key_word="vasp_std", workers=16, dry_run=False,
+                                     timeout=5):
+        nodes = self.get_nodes() or []
+        if dry_run:
+            return {node: "dry-run" for node in nodes}
+        if not nodes:
+            return {}
+        with ThreadPoolExecutor(min(workers, len(nodes))) as pool:
+            report = dict(pool.map(lambda node: self._kill_zombie_process(node, key_word, timeout),
+                                   nodes))
+        return report
 
 
 if __name__ == "__main__":
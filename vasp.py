@@ -1,13 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import sys
+import json
+import time
 import click
 from queue import Queue
 from calculation.vasp.job import VaspRunningJob, RunningRoot
-from calculation.npc import Submitter, Producer, Npc
+from calculation.vasp.runner import WorkflowRunner
+from calculation.npc import Submitter, AsyncSubmitter, Producer, Npc, max_resources, POLICIES, \
+    job_limits
+from calculation.vasp.analysis import WalltimeModel, collect_records, running_progress
+from calculation.pilot import Pilot, PilotWorker
+from calculation.simulation import SubmitSimulation, ENGINES
+from calculation.daemon import Controller, query
 from config import CONDOR
-from utils.yhurm import TianHeTime, TianHeWorker, TianHeNodes
+from utils.yhurm import TianHeTime, TianHeWorker, TianHeNodes, use_scheduler
+from utils.backend import get_backend, get_job_backend
+from utils import ALL_JOB_LOG, RUNNING_JOB_LOG, HPC_LOG
 from utils.spath import SPath
+from utils.wqueue import WorkQueue
 
 
 @click.group()
@@ -33,6 +45,31 @@ def errors(work_dir):
     return VaspRunningJob(SPath(work_dir)).automatic_check_errors()
 
 
+@vasp.command()
+@click.option("--work_dir", help="work directory")
+@click.option("--yhrun_rc", help="exit code of the yhrun of this try", default=0)
+@click.option("--job_id", help="id of the job running this step, default: $SLURM_JOB_ID",
+              default=None)
+def check(work_dir, yhrun_rc, job_id):
+    use_scheduler(get_job_backend())
+    sys.exit(VaspRunningJob(SPath(work_dir), job_id=job_id or None).check(yhrun_rc))
+
+
+@vasp.command()
+@click.option("--root", help="root directory")
+@click.option("--step", help="only run this workflow step", default=None)
+@click.option("--exclusive", help="yhrun --exclusive, for bundled jobs", is_flag=True)
+def execute(root, step, exclusive):
+    use_scheduler(get_job_backend())
+    runner = WorkflowRunner(SPath(root), exclusive=exclusive)
+    done = runner.run(step)
+    # like the bash flow: a whole workflow stops silently, a single step reports and fails
+    if done or step is not None:
+        runner.summary()
+    if step is not None and not done:
+        sys.exit(1)
+
+
 @vasp.command()
 @click.option("--log_name", help="log filename")
 @click.option("--work_dir", help="work directory")
@@ -68,70 +105,306 @@ def flush():
     worker.flush()
 
 
+@vasp.command()
+@click.option("--des", help="directory of the exported TSV files, default: next to the logs")
+def export(des):
+    for log in (ALL_JOB_LOG, RUNNING_JOB_LOG, HPC_LOG):
+        path = log.export(None if des is None else SPath(des) / f"{log.path.stem}.csv")
+        print(f"[...]{log} -> {path}")
+
+
+@vasp.command()
+def compact():
+    for log in (ALL_JOB_LOG, RUNNING_JOB_LOG, HPC_LOG):
+        if not hasattr(log, "compact"):
+            print(f"[...]{log} has no journal")
+            continue
+        log.compact()
+        print(f"[...]{log} compacted")
+
+
+@vasp.command()
+@click.option("--work_dir", help="work directory")
+def history(work_dir):
+    if not hasattr(ALL_JOB_LOG, "history"):
+        print("[...]job history needs [LOG] BACKEND = journal")
+        return None
+    events = ALL_JOB_LOG.history("WORKDIR", SPath(work_dir).absolute())
+    for event in events:
+        print(json.dumps(event))
+    return events
+
+
 @vasp.command()
 @click.option("--sec", help="sec limit", default=0)
 @click.option("--mins", help="mins limit", default=0)
 @click.option("--hour", help="hour limit", default=24)
 @click.option("--day", help="day limit", default=0)
-def limit(day, hour, mins, sec):
+@click.option("--predicted", help="use predicted walltime of every job as its limit", is_flag=True)
+def limit(day, hour, mins, sec, predicted):
     th_time = TianHeTime(day, hour, mins, sec)
     control_paras = {
         "partition": CONDOR.get("ALLOW", "PARTITION"),
         "total_allowed_node": CONDOR.getint("ALLOW", "TOTAL_NODE"),
     }
-    for job in TianHeWorker(**control_paras).yield_time_limit_exceed_jobs(th_time):
-        job.yhcancel()
+    limits = None
+    if predicted:
+        model = WalltimeModel.load()
+        if model is None:
+            print("[...]walltime model not found, use the fixed limit")
+        elif ALL_JOB_LOG.csv is not None:
+            limits = job_limits([job for _, job in ALL_JOB_LOG.csv.iterrows()], model)
+    worker = TianHeWorker(**control_paras)
+    job_ids = worker.time_limit_exceed_jobs(th_time, limits)
+    if job_ids:
+        exit_code, _ = worker.yhcancel(job_ids)
+        if exit_code == 0:
+            print(f"[...]cancel {len(job_ids)} jobs: {' '.join(job_ids)}")
+
+
+@vasp.command()
+@click.option("--z", help="safety factor in residual standard deviations, default: 1.645",
+              default=1.645)
+@click.option("--root", help="calculation dir of finished structures")
+def fit(root, z):
+    records = collect_records(SPath(root).walk(is_file=False))
+    model = WalltimeModel.fit(records, z=z)
+    model.save()
+    for step, para in model.params.items():
+        print(f"{step}: samples {para['n']}, sigma {para['sigma']:.3f}, ionic steps {para['ionic']:.0f}")
+    return model
 
 
 @vasp.command()
 @click.option("--job_id", help="job id")
 @click.option("--keyword", help="keyword of process name",
               default=CONDOR.get("VASP", "VASP_EXE"))
-def clear(job_id, keyword):
+@click.option("--workers", help="concurrent ssh sessions, default: 16", default=16)
+@click.option("--dry_run", help="only list the nodes of the job", is_flag=True)
+def clear(job_id, keyword, workers, dry_run):
     thn = TianHeNodes(job_id)
-    thn.kill_zombie_process_on_nodes(key_word=keyword)
+    report = thn.kill_zombie_process_on_nodes(key_word=keyword, workers=workers, dry_run=dry_run)
+    for node, outcome in report.items():
+        print(f"{node}: {outcome}")
+    return report
+
+
+def _use_backend():
+    backend = get_backend()
+    use_scheduler(backend)
+    return backend
+
+
+def _start(producer, submitter, backend=None):
+    producer.start()
+    submitter.start()
+    producer.join()
+    submitter.join()
+    if backend is not None:
+        print("[...]waiting for local jobs...")
+        backend.wait()
+
+
+def _submitter(engine, job_queue, stime, ftime, inflight, **control_paras):
+    if engine == "thread":
+        return Submitter(job_queue, stime, ftime, **control_paras)
+    return AsyncSubmitter(job_queue, ftime, inflight, **control_paras)
 
 
 @vasp.command()
-@click.option("--stime", help="interval time(sec) between submit job", default=0.5)
+@click.option("--stime", help="interval time(sec) between submit job, thread engine only", default=0.5)
 @click.option("--ftime", help="interval time(sec) between yhi", default=60)
 @click.option("--qsize", help="queue size, default: 20", default=20)
 @click.option("--process", help="multiprocessing num, default: 4", default=4)
+@click.option("--engine", help="submission engine, default: async",
+              type=click.Choice(["async", "thread"]), default="async")
+@click.option("--inflight", help="max concurrent yhbatch calls, async engine only", default=16)
+@click.option("--per_step", help="submit every workflow step as its own job", is_flag=True)
+@click.option("--policy", help="submission order by estimated cost, default: fifo",
+              type=click.Choice(POLICIES), default="fifo")
+@click.option("--predict_time", help="request predicted walltime from yhbatch", is_flag=True)
 @click.option("--pat", help="structure files type, default: *.vasp",
               default=f"{CONDOR.get('STRU', 'SUFFIX')}")
 @click.option("--stru_dir", help="structure files directory",
               default=f"{CONDOR.get('STRU', 'PATH')}")
-def run(stru_dir, pat, process=4, qsize=20, stime=0.5, ftime=60):
+def run(stru_dir, pat, process=4, qsize=20, stime=0.5, ftime=60, engine="async", inflight=16,
+        per_step=False, policy="fifo", predict_time=False):
     job_queue = Queue(maxsize=qsize)
     control_paras = {
         "partition": CONDOR.get("ALLOW", "PARTITION"),
         "total_allowed_node": CONDOR.getint("ALLOW", "TOTAL_NODE"),
     }
 
-    mana = Npc(SPath(stru_dir), interval_time=stime)
+    bundle_size = CONDOR.getint("BUNDLE", "SIZE", fallback=1)
+    producer = Producer(queue=job_queue, per_step=per_step, bundle_size=bundle_size,
+                        policy=policy, process=process, predict_time=predict_time)
+    mana = Npc(SPath(stru_dir), interval_time=stime, per_step=per_step,
+               exclusive=bundle_size > 1)
     mana.init_jobs(pat, process)
-    producer = Producer(queue=job_queue)
-    submitter = Submitter(job_queue, stime, ftime, **control_paras)
-
-    producer.start()
-    submitter.start()
+    backend = _use_backend()
+    submitter = _submitter(engine, job_queue, stime, ftime, inflight, **control_paras)
+    _start(producer, submitter, backend)
 
 
 @vasp.command()
 @click.option("--cdir", help="calculation dir")
-def crun(cdir, process=4, qsize=20, stime=0.5, ftime=60):
+@click.option("--engine", help="submission engine, default: async",
+              type=click.Choice(["async", "thread"]), default="async")
+@click.option("--per_step", help="submit every workflow step as its own job", is_flag=True)
+@click.option("--policy", help="submission order by estimated cost, default: fifo",
+              type=click.Choice(POLICIES), default="fifo")
+@click.option("--predict_time", help="request predicted walltime from yhbatch", is_flag=True)
+def crun(cdir, process=4, qsize=20, stime=0.5, ftime=60, engine="async", inflight=16,
+         per_step=False, policy="fifo", predict_time=False):
     job_queue = Queue(maxsize=qsize)
     control_paras = {
         "partition": CONDOR.get("ALLOW", "PARTITION"),
         "total_allowed_node": CONDOR.getint("ALLOW", "TOTAL_NODE"),
     }
-    mana = Npc(SPath(cdir), interval_time=stime)
+    bundle_size = CONDOR.getint("BUNDLE", "SIZE", fallback=1)
+    producer = Producer(queue=job_queue, per_step=per_step, bundle_size=bundle_size,
+                        policy=policy, process=process, predict_time=predict_time)
+    mana = Npc(SPath(cdir), interval_time=stime, per_step=per_step,
+               exclusive=bundle_size > 1)
     mana.cinit_jobs(process)
-    producer = Producer(queue=job_queue)
-    submitter = Submitter(job_queue, stime, ftime, **control_paras)
+    backend = _use_backend()
+    submitter = _submitter(engine, job_queue, stime, ftime, inflight, **control_paras)
+    _start(producer, submitter, backend)
+
+
+@vasp.command()
+@click.option("--nodes", help="nodes of every pilot job, default: 4", default=4)
+@click.option("--pilots", help="number of pilot jobs, default: 1", default=1)
+@click.option("--walltime", help="walltime of every pilot job, default: 1-00:00:00",
+              default="1-00:00:00")
+@click.option("--reserve", help="seconds kept free before walltime, default: 600", default=600)
+@click.option("--process", help="multiprocessing num, default: 4", default=4)
+@click.option("--cdir", help="calculation dir, continue unfinished jobs", default=None)
+@click.option("--policy", help="queue order by estimated cost, default: fifo",
+              type=click.Choice(POLICIES), default="fifo")
+@click.option("--pat", help="structure files type, default: *.vasp",
+              default=f"{CONDOR.get('STRU', 'SUFFIX')}")
+@click.option("--stru_dir", help="structure files directory",
+              default=f"{CONDOR.get('STRU', 'PATH')}")
+def pilot(stru_dir, pat, policy, cdir, process, reserve, walltime, pilots, nodes):
+    if cdir is not None:
+        Npc(SPath(cdir), exclusive=True).cinit_jobs(process)
+    else:
+        Npc(SPath(stru_dir), exclusive=True).init_jobs(pat, process)
+    slice_node, slice_core = max_resources()
+    pilot_job = Pilot(nodes=nodes, slice_node=slice_node, slice_core=slice_core,
+                      walltime=walltime, reserve=reserve)
+    print(f"total: {pilot_job.build_queue(policy, process)} jobs queued!")
+    job_ids = pilot_job.submit(pilots)
+    print(f"pilot jobs submitted: {', '.join(job_ids)}")
+
+
+@vasp.command()
+@click.option("--slice", "slice_id", help="slice index of the allocation", default=0)
+@click.option("--deadline", help="unix time after which no job is pulled", type=float)
+@click.option("--queue", help="work queue directory")
+def pull(queue, deadline, slice_id):
+    return PilotWorker(WorkQueue(SPath(queue)), deadline, slice_id).run()
+
+
+@vasp.command()
+@click.option("--jobs", help="jobs of the campaign, default: 1000", default=1000)
+@click.option("--nodes", help="nodes of the simulated partition, default: 64", default=64)
+@click.option("--limit", help="user node limit, default: all nodes", type=int, default=None)
+@click.option("--runtime", help="job runtime distribution, fixed:T, uniform:A,B, exp:MEAN or "
+                                "lognormal:MEDIAN,SIGMA, default: lognormal:3600,0.5",
+              default="lognormal:3600,0.5")
+@click.option("--stime", help="interval time(sec) between submit job, thread engine only",
+              default=0.5)
+@click.option("--ftime", help="interval time(sec) between yhi", default=60)
+@click.option("--engine", help="submission engine, default: async",
+              type=click.Choice(ENGINES), default="async")
+@click.option("--qsize", help="queue size between producer and submitter, default: 20", default=20)
+@click.option("--inflight", help="max concurrent yhbatch calls, async engine only", default=16)
+@click.option("--policy", help="submission order by estimated cost, default: fifo",
+              type=click.Choice(POLICIES), default="fifo")
+@click.option("--noise", help="log-normal error of the cost estimate, default: 0.3", default=0.3)
+@click.option("--latency", help="seconds every scheduler command takes, default: 0.1",
+              default=0.1)
+@click.option("--seed", help="random seed, default: 0", default=0)
+@click.option("--verbose", help="show the submitter output", is_flag=True)
+def simulate(jobs, nodes, limit, runtime, stime, ftime, engine, qsize, inflight, policy, noise,
+             latency, seed, verbose):
+    job_node, job_core = max_resources()
+    campaign = SubmitSimulation(jobs=jobs, nodes=nodes, limit=limit, job_node=job_node,
+                                job_core=job_core, runtime=runtime, noise=noise, latency=latency,
+                                seed=seed, partition=CONDOR.get("ALLOW", "PARTITION"))
+    stats = campaign.run(stime=stime, ftime=ftime, policy=policy, verbose=verbose, engine=engine,
+                         qsize=qsize, inflight=inflight)
+    campaign.report(stats)
+    return stats
+
+
+@vasp.command()
+@click.option("--cdir", help="calculation dir, prepare unfinished jobs first", default=None)
+@click.option("--des", help="move successed structures into this dir", default=None)
+@click.option("--interval", help="seconds between reconcile cycles, default: 60", default=60)
+@click.option("--max_retry", help="resubmissions of a failed job, default: 3", default=3)
+@click.option("--backoff", help="first retry delay in seconds, doubled every retry, default: 300",
+              default=300)
+@click.option("--forever", help="keep running after the campaign finished", is_flag=True)
+@click.option("--per_step", help="submit every workflow step as its own job", is_flag=True)
+def daemon(cdir, des, interval, max_retry, backoff, forever, per_step):
+    control_paras = {
+        "partition": CONDOR.get("ALLOW", "PARTITION"),
+        "total_allowed_node": CONDOR.getint("ALLOW", "TOTAL_NODE"),
+    }
+    if cdir is not None:
+        Npc(SPath(cdir), per_step=per_step).cinit_jobs()
+    backend = _use_backend()
+    controller = Controller(des=SPath(des).absolute() if des else None, interval=interval,
+                            max_retry=max_retry, backoff=backoff, per_step=per_step,
+                            bundle_size=CONDOR.getint("BUNDLE", "SIZE", fallback=1),
+                            **control_paras)
+    controller.run(forever)
+    if backend is not None:
+        backend.wait()
+
+
+@vasp.command()
+@click.option("--stop", help="ask the daemon to stop", is_flag=True)
+def status(stop):
+    try:
+        reply = query("stop" if stop else "status")
+    except (FileNotFoundError, ConnectionRefusedError):
+        print("[...]daemon is not running")
+        return None
+    print(json.dumps(reply, indent=2))
+    return reply
+
+
+def _trend(values, fmt="{:.1e}"):
+    return "->".join(fmt.format(v) for v in values) if values else "-"
+
+
+@vasp.command()
+@click.option("--workers", help="threads reading the job directories, default: 32", default=32)
+@click.option("--refresh", help="query the scheduler before reading the jobs", is_flag=True)
+def progress(refresh, workers):
+    if refresh:
+        TianHeWorker(partition=CONDOR.get("ALLOW", "PARTITION"),
+                     total_allowed_node=CONDOR.getint("ALLOW", "TOTAL_NODE")).snapshot()
+    start = time.time()
+    jobs = running_progress(workers)
+    print(f"{'JOBID':<10}{'STRUCTURE':<24}{'STEP':<10}{'IONIC':>9}  {'SCF':<12}{'NOW':>4}"
+          f"{'dE':>10}  {'FORCE':<26}{'FINISH':>12}")
+    for job in jobs:
+        ionic = f"{job['ionic']}/{job['nsw']}" if "ionic" in job else "-"
+        d_e = "-" if job.get("dE") is None else f"{job['dE']:.1e}"
+        finish = "-" if job.get("eta") is None else \
+            time.strftime("%m-%d %H:%M" if job["eta"] > 86400 else "%H:%M:%S",
+                          time.localtime(start + job["eta"]))
+        print(f"{job['job_id']:<10}{SPath(job['root']).name:<24}{str(job['step']):<10}{ionic:>9}  "
+              f"{_trend(job.get('scf'), '{}'):<12}{job.get('current_scf', '-'):>4}{d_e:>10}  "
+              f"{_trend(job.get('forces'), '{:.3f}'):<26}{finish:>12}")
+    print(f"[...]{len(jobs)} running jobs read in {time.time() - start:.2f}s")
+    return jobs
 
-    producer.start()
-    submitter.start()
 
 @vasp.command()
 @click.option("--des", help="des dir")